@@ -0,0 +1,167 @@
+
+"""Asyncio interface to Slack WebHooks"""
+
+import asyncio
+import logging
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+from git_slack.slack import BaseWebHook, MessageScheduler
+from git_slack.connection import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSlackWebHook(BaseWebHook):
+    """Asyncio interface to WebHooks API
+
+    Provides the same enqueue/stop interface as SlackWebHook. Messages
+    are ordered, coalesced and rate limited by a MessageScheduler created
+    from the keyword arguments, but up to max_concurrency posts are in
+    flight at a time: one per channel, so that messages to a channel
+    keep their order. Rate limit waits are event loop timers.
+
+    The delivery loop is the serve() coroutine, which can be run in an
+    existing event loop. Alternatively, start() runs it in a new event
+    loop in a background thread.
+
+    Posts are made over a ConnectionPool from a thread pool executor.
+    See BaseWebHook for the queue, spool and retry options; when the
+    queue is full, enqueue blocks the calling thread, so it must not be called
+    from the event loop thread when a limit is set.
+    """
+
+    def __init__(self, endpoint=None, pool=None, max_concurrency=4,
+                 max_queue_size=0, spool=None, max_retries=5,
+                 retry_delay=1.0, max_retry_delay=300.0, dead_letter=None,
+                 **kwargs):
+        super(AsyncSlackWebHook, self).__init__(
+            max_queue_size, spool, max_retries, retry_delay,
+            max_retry_delay, dead_letter)
+        self._endpoint = endpoint
+        self._max_concurrency = max_concurrency
+        self._pool = (ConnectionPool(max_size=max_concurrency)
+                      if pool is None else pool)
+        self._scheduler = MessageScheduler(endpoint, **kwargs)
+        for delivery in self._spooled_deliveries():
+            self._scheduler.add(delivery)
+        self._loop = None
+        self._wakeup = None
+        self._busy = set()
+        self._thread = None
+        self._running = True
+
+    def _add(self, delivery):
+        self._scheduler.add(delivery)
+        self._wakeup.set()
+
+    def enqueue(self, message, callback=None, trace=None):
+        """Add message to queue; safe to call from any thread
+
+        The callback is called from the event loop thread when the
+        message has been posted or given up on. If a Trace is given, the
+        progress of the message is marked in it.
+        """
+        self._loop.call_soon_threadsafe(
+            self._add, self._new_delivery(message, callback, trace))
+
+    def _stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def stop(self):
+        """Stop delivery loop; safe to call from any thread"""
+        self._loop.call_soon_threadsafe(self._stop)
+
+    def bind(self, loop=None):
+        """Bind hook to event loop so messages can be enqueued
+
+        Called by serve() but can be called earlier so that messages can
+        be enqueued before the delivery loop runs.
+        """
+        if self._loop is None:
+            self._loop = (asyncio.get_running_loop() if loop is None
+                          else loop)
+            self._wakeup = asyncio.Event()
+
+    def start(self):
+        """Run delivery loop in a new event loop in a background thread"""
+        self.bind(asyncio.new_event_loop())
+        self._thread = Thread(target=self._loop.run_until_complete,
+                              args=(self.serve(),))
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _is_alive(self):
+        return self._loop is not None and self._running and (
+            self._thread is None or self._thread.is_alive())
+
+    async def serve(self):
+        """Run delivery loop, restarting it if it fails"""
+        self.bind(asyncio.get_running_loop())
+        executor = ThreadPoolExecutor(self._max_concurrency)
+        tasks = set()
+        try:
+            while self._running:
+                try:
+                    await self._deliver(executor, tasks)
+                except Exception as e:
+                    self._restarts += 1
+                    self._record_error(e)
+                    logger.error('Delivery worker failed; restarting:',
+                                 exc_info=True)
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(),
+                                               self._restart_delay())
+                    except asyncio.TimeoutError:
+                        pass
+
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            executor.shutdown()
+            self._pool.close()
+
+    async def _deliver(self, executor, tasks):
+        """Delivery loop"""
+        while self._running:
+            self._wakeup.clear()
+            delivery = None
+            if len(self._busy) < self._max_concurrency:
+                delivery = self._scheduler.next_delivery(self._busy)
+
+            if delivery is None:
+                # Wait until a channel is ready, a post is done or a new
+                # message arrives
+                timeout = (self._scheduler.wait_time(self._busy)
+                           if len(self._busy) < self._max_concurrency
+                           else None)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delivery.mark('dequeued')
+            key = self._scheduler.bucket_key(delivery)
+            self._busy.add(key)
+            task = asyncio.ensure_future(
+                self._post(executor, key, delivery))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def _post(self, executor, key, delivery):
+        self._log_post(delivery)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                executor, self._send, delivery)
+        except Exception as e:
+            self._failed(delivery, e)
+        else:
+            self._posted(delivery)
+        finally:
+            self._busy.discard(key)
+            self._wakeup.set()
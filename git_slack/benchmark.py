@@ -0,0 +1,222 @@
+
+"""Microbenchmarks of the rule, render and serialize hot paths
+
+Run with ``python -m git_slack.benchmark``. Results can be written as
+JSON with --output and compared against an earlier result with
+--baseline, in which case the exit status is non-zero if any benchmark
+got slower than the baseline by more than the tolerance.
+"""
+
+import re
+import sys
+import json
+import random
+import timeit
+import argparse
+import platform
+from functools import partial
+
+from git_slack import slack
+from git_slack.response import apply_rules, message_from_push
+from git_slack.rules import RuleSet
+
+
+def make_commit(index, rng):
+    """Return synthetic commit object"""
+    commit_id = '{:040x}'.format(rng.getrandbits(160))
+    message = 'Change {} of <module> & friends\n\n{}'.format(
+        index, 'Details of the change. ' * rng.randint(0, 20))
+    return {
+        'id': commit_id,
+        'message': message,
+        'url': 'https://git.example.com/commit/{}'.format(commit_id),
+        'author': {'name': 'Author {}'.format(rng.randint(0, 50))}
+    }
+
+
+def make_push(commit_count, repository='org/repo-0', branch='master',
+              seed=0):
+    """Return synthetic push object with a number of commits"""
+    rng = random.Random(seed)
+    return {
+        'before': '{:040x}'.format(rng.getrandbits(160)),
+        'after': '{:040x}'.format(rng.getrandbits(160)),
+        'ref': 'refs/heads/' + branch,
+        'url': 'https://git.example.com/{}/tree/{}'.format(
+            repository, branch),
+        'created': False,
+        'deleted': False,
+        'commits': [make_commit(i, rng) for i in range(commit_count)],
+        'repository': {
+            'full_name': repository,
+            'url': 'https://git.example.com/' + repository
+        }
+    }
+
+
+def make_rules(count):
+    """Return list of count synthetic rules
+
+    Most rules route a single repository to a channel; every tenth rule
+    uses a pattern and every hundredth filters branches, so that the
+    rule index and the pattern fallback are both exercised.
+    """
+    rules = []
+    for i in range(count):
+        if i % 100 == 99:
+            rules.append({'filter': 'exclude', 'branch': 'wip/.*'})
+        elif i % 10 == 9:
+            rules.append({'repository': r'org/team-{}-.*'.format(i),
+                          'channel': '#team-{}'.format(i),
+                          'commit_url': 'https://git.example.com/'
+                                        '{repository}/commit/{commit}'})
+        else:
+            rules.append({'repository': 'org/repo-{}'.format(i),
+                          'channel': '#repo-{}'.format(i)})
+    return rules
+
+
+def _apply_and_render(push, rules):
+    for p, username, channel in apply_rules(push, rules):
+        message_from_push(p, username, channel)
+
+
+def _document(attachment_args):
+    message = slack.Message(attachments=[slack.Attachment(**attachment_args)],
+                            channel='#general')
+    return message.payload()
+
+
+def benchmarks():
+    """Yield name and function of each benchmark"""
+    for count in (10, 100, 1000, 5000):
+        rules = RuleSet(make_rules(count), cache_size=0)
+        push = make_push(1, repository='org/repo-{}'.format(count - 2))
+        yield ('apply_rules/{}'.format(count),
+               partial(_apply_and_render, push, rules))
+
+    rules = RuleSet(make_rules(5000))
+    push = make_push(1, repository='org/repo-4998')
+    yield 'apply_rules/5000/cached', partial(_apply_and_render, push, rules)
+
+    for count in (1, 50, 1000, 50000):
+        push = make_push(count)
+        yield ('message_from_push/{}'.format(count),
+               partial(message_from_push, push))
+
+    yield 'markup/escape/short', partial(slack.Markup.escape, 'a < b & c')
+    yield 'markup/escape/long', partial(slack.Markup.escape,
+                                        'x < y & z > w ' * 500)
+    link = slack.Link('https://git.example.com/?a=1&b=2', 'a < b')
+    yield 'markup/format', partial(slack.Markup('{}: {} - {}').format,
+                                   link, 'Fix <tag> & more', 'Someone')
+    lines = [slack.Markup('line {} &amp; more'.format(i)) for i in range(100)]
+    yield 'markup/join/100', partial(slack.Markup('\n').join, lines)
+
+    attachment = message_from_push(make_push(50)).attachments[0]
+    args = {'fallback': attachment.fallback, 'pretext': attachment.pretext,
+            'color': attachment.color, 'text': attachment.text}
+    yield 'message/payload', partial(_document, args)
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """Return best time per call in seconds and the number of calls"""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9) / repeat))
+    best = min(timer.repeat(repeat, number))
+    return best / number, number
+
+
+def run(pattern=None, min_time=0.2, repeat=5, report=None):
+    """Run benchmarks matching pattern and return dict of results"""
+    results = {}
+    for name, func in benchmarks():
+        if pattern is not None and not re.search(pattern, name):
+            continue
+        seconds, number = measure(func, min_time, repeat)
+        results[name] = {'seconds': seconds, 'number': number}
+        if report is not None:
+            report(name, seconds)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results
+    }
+
+
+def compare(current, baseline, tolerance=0.25):
+    """Return list of regressions of current results against baseline
+
+    Each regression is a tuple of name, baseline and current seconds.
+    Benchmarks missing from either result are ignored.
+    """
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        if result['seconds'] > base['seconds'] * (1.0 + tolerance):
+            regressions.append((name, base['seconds'], result['seconds']))
+    return regressions
+
+
+def _format_time(seconds):
+    for unit, scale in (('s', 1.0), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds / 1e-9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m git_slack.benchmark',
+        description='Run git-slack microbenchmarks')
+    parser.add_argument('--filter', metavar='REGEX',
+                        help='Only run benchmarks matching REGEX')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Approximate seconds to spend per benchmark')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timing runs per benchmark')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write results as JSON to FILE (- for stdout)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare results to JSON results in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown relative to the baseline')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    def report(name, seconds):
+        line = '{:<32} {:>10}'.format(name, _format_time(seconds))
+        if baseline is not None and name in baseline['results']:
+            base = baseline['results'][name]['seconds']
+            line += '  {:+.1%}'.format(seconds / base - 1.0)
+        print(line, file=sys.stderr if args.output == '-' else sys.stdout)
+
+    current = run(args.filter, args.min_time, args.repeat, report)
+
+    if args.output == '-':
+        json.dump(current, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(current, baseline, args.tolerance)
+        for name, base, seconds in regressions:
+            print('Regression: {} took {} (baseline {})'.format(
+                name, _format_time(seconds), _format_time(base)),
+                file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+
+"""Caching utilities"""
+
+import os
+import json
+import math
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry
+
+    Counts hits and misses of lookups. The cache is safe to use from
+    multiple threads.
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, self._missing)
+            if value is self._missing:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return dict of cache statistics"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self._maxsize}
+
+
+class DedupeCache(object):
+    """Bounded set of recently seen keys that expire after ttl seconds
+
+    add() returns whether a key is new, so that repeated events can be
+    dropped. Keys are first held in memory only; once confirm() is called
+    for a key it is also written to the file at path, if given, so that
+    it is remembered across restarts. The file is rewritten at most every
+    save_interval seconds as keys are added, and by save(). Keys must be
+    tuples of JSON-serializable values. The cache is safe to use from
+    multiple threads.
+    """
+    def __init__(self, maxsize=10000, ttl=3600.0, path=None,
+                 save_interval=10.0, clock=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._path = path
+        self._save_interval = save_interval
+        self._clock = time.time if clock is None else clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._dirty = False
+        self._saved = self._clock()
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        while self._entries:
+            key, (expires, _) = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self._maxsize:
+                break
+            del self._entries[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > self._clock()
+
+    def add(self, key):
+        """Add key and return True if it was not already present"""
+        with self._lock:
+            now = self._clock()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            self._entries.pop(key, None)
+            self._entries[key] = [now + self._ttl, False]
+            self._expire(now)
+
+        if (self._path is not None and self._dirty and
+                now - self._saved >= self._save_interval):
+            self.save()
+        return True
+
+    def confirm(self, key):
+        """Remember key across restarts"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not entry[1]:
+                entry[1] = True
+                self._dirty = True
+
+    def discard(self, key):
+        """Forget key, so that it is new when added again"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1]:
+                self._dirty = True
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                entries = json.load(f)['entries']
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.warning('Unable to load dedupe cache {}'.format(
+                self._path), exc_info=True)
+            return
+
+        now = self._clock()
+        for key, expires in sorted(entries, key=lambda e: e[1]):
+            if expires > now:
+                self._entries[tuple(key)] = [expires, True]
+        self._expire(now)
+
+    def save(self):
+        """Write confirmed keys to file"""
+        if self._path is None:
+            return
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            entries = [[list(key), expires] for key, (expires, confirmed)
+                       in self._entries.items() if confirmed]
+            self._dirty = False
+            self._saved = now
+
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'entries': entries}, f)
+            os.replace(temp_path, self._path)
+        except OSError:
+            logger.warning('Unable to save dedupe cache {}'.format(
+                self._path), exc_info=True)
+
+
+class RotatingBloomFilter(object):
+    """Approximate set of recently added strings in bounded memory
+
+    Keys are added to the current of two Bloom filters, each sized for
+    capacity keys with a false positive rate of error_rate, i.e. about
+    1.8 bytes per key at the default rate. When the current filter is
+    full it replaces the previous one, which is dropped, so the last
+    capacity to 2 * capacity keys are remembered. Membership tests have
+    no false negatives for remembered keys and false positives at up to
+    twice error_rate. The filter is safe to use from multiple threads.
+    """
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self._capacity = capacity
+        self._bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self._hashes = max(1, int(round(
+            self._bits / capacity * math.log(2))))
+        self._current = bytearray((self._bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0
+        self._lock = Lock()
+
+    @property
+    def nbytes(self):
+        """Memory used by the filter bits"""
+        return len(self._current) + len(self._previous)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self._bits
+                for i in range(self._hashes)]
+
+    @staticmethod
+    def _test(bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            return (self._test(self._current, positions) or
+                    self._test(self._previous, positions))
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            if self._test(self._current, positions):
+                return
+            if self._count >= self._capacity:
+                self._previous = self._current
+                self._current = bytearray(len(self._previous))
+                self._count = 0
+            for p in positions:
+                self._current[p >> 3] |= 1 << (p & 7)
+            self._count += 1
@@ -0,0 +1,122 @@
+
+"""Persistent HTTP connections"""
+
+import http.client
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from threading import Lock
+from collections import deque
+import logging
+
+from git_slack.log import EventLog
+
+logger = logging.getLogger(__name__)
+log = EventLog(logger)
+
+
+# Errors that indicate that a reused connection was closed by the server
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                 ConnectionResetError, ConnectionAbortedError,
+                 BrokenPipeError)
+
+
+class Response(object):
+    """Response to a request"""
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class ConnectionPool(object):
+    """Pool of persistent keep-alive connections per host
+
+    Up to max_size idle connections are kept open for each scheme, host
+    and port. If a request fails because the server has closed an idle
+    connection, it is retried once on a new connection. The pool is safe
+    to use from multiple threads.
+    """
+    def __init__(self, max_size=2, timeout=30.0):
+        self._max_size = max_size
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = Lock()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port,
+                                               timeout=self._timeout)
+        elif scheme == 'http':
+            return http.client.HTTPConnection(host, port,
+                                              timeout=self._timeout)
+        raise ValueError('Unsupported URL scheme: {}'.format(scheme))
+
+    def _acquire(self, key):
+        """Return idle connection or new connection and whether it is new"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), False
+        return self._connect(key), True
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self._max_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def request(self, method, url, body=None, headers={}):
+        """Send request and return Response
+
+        Raises HTTPError if the server responds with an error status.
+        """
+        parts = urlsplit(url)
+        key = parts.scheme, parts.hostname, parts.port
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            conn, new = self._acquire(key)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except _STALE_ERRORS:
+                conn.close()
+                if new:
+                    raise
+                log.debug('reconnect', 'Reconnecting to {host}',
+                          host=parts.netloc)
+                continue
+            except:
+                conn.close()
+                raise
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.headers,
+                            None)
+
+        return Response(resp.status, resp.reason, resp.headers, data)
+
+    def post(self, url, data, content_type='application/json'):
+        return self.request('POST', url, data,
+                            {'Content-Type': content_type})
@@ -0,0 +1,815 @@
+
+"""Daemon posting Git push information from AMQP to Slack"""
+
+import os
+import zlib
+import time
+import signal
+import socket
+import traceback
+import multiprocessing
+import argparse
+import logging
+from collections import deque
+from functools import partial
+from threading import Thread, Event, Lock, current_thread, main_thread
+from queue import Empty
+
+from kombu import Connection, Exchange, Queue, Consumer
+import yaml
+
+from git_slack import slack, response, aio, spool
+from git_slack.digest import DigestCollector, DigestEntry
+from git_slack.cache import DedupeCache, RotatingBloomFilter
+from git_slack.connection import ConnectionPool
+from git_slack.metrics import Counter, Gauge, Histogram, MetricsServer
+from git_slack.trace import Tracer, TraceFile
+from git_slack.log import EventLog, StructuredFormatter, configure_events
+
+logger = logging.getLogger(__name__)
+log = EventLog(logger)
+
+
+PUSHES = Counter('git_slack_pushes', 'Git push messages received')
+DUPLICATE_PUSHES = Counter('git_slack_duplicate_pushes',
+                           'Git push messages dropped as duplicates')
+PUSH_ERRORS = Counter('git_slack_push_errors',
+                      'Git push messages that could not be processed')
+APPLY_RULES_SECONDS = Histogram('git_slack_apply_rules_seconds',
+                                'Duration of applying rules to a push')
+RENDER_SECONDS = Histogram('git_slack_render_seconds',
+                           'Duration of rendering a push as a message')
+CONFIG_RELOADS = Counter('git_slack_config_reloads',
+                         'Configuration reloads by result', ['result'])
+QUEUE_DEPTH = Gauge('git_slack_queue_depth',
+                    'Messages waiting to be posted to Slack')
+
+
+class ConfigError(Exception):
+    """Error in configuration"""
+
+
+# Options of the slack section that are passed on to the WebHook
+HOOK_OPTIONS = (
+    'min_post_delay', 'rate', 'burst', 'endpoint_rate', 'endpoint_burst',
+    'max_attachments', 'max_message_size', 'max_queue_size', 'max_retries',
+    'retry_delay', 'max_retry_delay')
+
+
+def load_config(path):
+    """Load YAML configuration file"""
+    with open(path, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+
+def amqp_url(config):
+    """Return URL of AMQP server
+
+    The URL is taken from amqp.url in the configuration; by default the
+    server is found from the environment of a linked Docker container.
+    """
+    url = config.get('amqp', {}).get('url')
+    if url is not None:
+        return url
+    server_host = os.environ.get('AMQP_PORT_5672_TCP_ADDR', 'localhost')
+    server_port = int(os.environ.get('AMQP_PORT_5672_TCP_PORT', '5672'))
+    return 'amqp://{}:{}'.format(server_host, server_port)
+
+
+def create_hook(config):
+    """Return Slack WebHook connector and its spool from configuration
+
+    The hook is not started. Returns None for the hook if no WebHook URL
+    is configured.
+    """
+    slack_config = config.get('slack', {})
+    if 'webhook_url' not in slack_config:
+        logger.warning('No Slack URL defined! No messages will be sent.')
+        logger.warning('Set "slack.webhook_url" in the configuration' +
+                       ' file to enable Slack messages.')
+        return None, None
+
+    logger.info('Using Slack WebHook URL: {}'.format(
+        slack_config['webhook_url']))
+    hook_options = {key: slack_config[key] for key in HOOK_OPTIONS
+                    if key in slack_config}
+    if 'dead_letter_file' in slack_config:
+        hook_options['dead_letter'] = slack.DeadLetterFile(
+            slack_config['dead_letter_file'])
+    hook_options.setdefault('max_queue_size', 1000)
+    if slack_config.get('merge_pushes', True):
+        hook_options['supersede'] = response.supersede_message
+    pool = ConnectionPool(
+        max_size=slack_config.get('pool_size', 2),
+        timeout=slack_config.get('timeout', 30.0))
+
+    engine = slack_config.get('engine', 'thread')
+    if engine not in ('thread', 'asyncio'):
+        raise ConfigError('Invalid Slack delivery engine: {}'.format(engine))
+
+    hook_spool = None
+    if 'spool_dir' in slack_config:
+        hook_spool = spool.Spool(slack_config['spool_dir'])
+        hook_options['spool'] = hook_spool
+
+    if engine == 'asyncio':
+        if 'max_concurrency' in slack_config:
+            hook_options['max_concurrency'] = slack_config['max_concurrency']
+        hook = aio.AsyncSlackWebHook(slack_config['webhook_url'],
+                                     pool=pool, **hook_options)
+    else:
+        hook = slack.SlackWebHook(slack_config['webhook_url'],
+                                  pool=pool, **hook_options)
+    return hook, hook_spool
+
+
+def create_dedupe(config):
+    """Return cache of recently seen pushes from configuration
+
+    Returns None if suppression of duplicate pushes is disabled.
+    """
+    options = config.get('dedupe', {})
+    if options is False:
+        return None
+    options = options or {}
+    return DedupeCache(options.get('max_size', 10000),
+                       options.get('ttl', 3600.0), options.get('file'))
+
+
+def create_digests(config):
+    """Return DigestCollector keeping digests in the spool directory
+
+    Digests are only kept in memory if no spool directory is configured.
+    """
+    spool_dir = config.get('slack', {}).get('spool_dir')
+    if spool_dir is None:
+        return DigestCollector()
+    return DigestCollector(
+        spool=spool.Spool(os.path.join(spool_dir, 'digests')))
+
+
+def push_key(body):
+    """Return key identifying push or None if the push is malformed"""
+    try:
+        return (str(body['repository']['full_name']), str(body['ref']),
+                str(body['before']), str(body['after']))
+    except (KeyError, TypeError):
+        return None
+
+
+def create_tracer(config):
+    """Return Tracer from tracing section or None if not configured"""
+    if 'tracing' not in config:
+        return None
+    tracing = config['tracing'] or {}
+    sink = None
+    if 'file' in tracing:
+        sink = TraceFile(tracing['file'])
+    return Tracer(tracing.get('sample_rate', 1.0),
+                  tracing.get('slow_threshold', 60.0), sink)
+
+
+# Options of the slack section used to render messages, which can be
+# reloaded; other changes only take effect after a restart
+RENDER_OPTIONS = ('username', 'channel', 'max_commits', 'max_text_size')
+RESTART_SECTIONS = ('amqp', 'workers', 'metrics', 'dedupe')
+
+
+def restart_changes(old, new):
+    """Return names of changed settings that require a restart"""
+    changes = [section for section in RESTART_SECTIONS
+               if old.get(section) != new.get(section)]
+    old_slack, new_slack = old.get('slack') or {}, new.get('slack') or {}
+    changes.extend('slack.{}'.format(key) for key in sorted(
+        set(old_slack) | set(new_slack))
+        if key not in RENDER_OPTIONS and
+        old_slack.get(key) != new_slack.get(key))
+    return changes
+
+
+class PushRenderer(object):
+    """Applies rules to Git pushes and renders them as Slack messages
+
+    If seen_commits is configured, commits of a repository that were
+    already announced, e.g. on the branch they were merged from, are
+    collapsed into a count. Pushes routed by a rule with a digest window
+    are rendered as a DigestEntry instead of a message.
+
+    When replacing a previous renderer after a configuration reload, its
+    seen commits are kept unless their settings changed.
+    """
+    def __init__(self, config, previous=None):
+        # Define Slack message options
+        slack_config = config.get('slack', {})
+        self._slack_username = None
+        self._slack_channel = None
+        if 'username' in slack_config:
+            self._slack_username = str(slack_config['username'])
+        if 'channel' in slack_config:
+            self._slack_channel = str(slack_config['channel'])
+
+        # Limits on the commit list of a message
+        self._message_options = {key: slack_config[key] for key in (
+            'max_commits', 'max_text_size') if key in slack_config}
+
+        # Define routing/filtering rules
+        self._rules = response.RuleSet(
+            config.get('rules', []),
+            cache_size=config.get('rule_cache_size', 1024))
+
+        # Commits already announced
+        self._seen = None
+        self._seen_options = config.get('seen_commits')
+        if (previous is not None and
+                previous._seen_options == self._seen_options):
+            self._seen = previous._seen
+        elif 'seen_commits' in config:
+            options = config['seen_commits'] or {}
+            self._seen = RotatingBloomFilter(
+                options.get('capacity', 1000000),
+                options.get('error_rate', 0.001))
+
+    @staticmethod
+    def _commit_keys(body):
+        repository = body['repository']['full_name']
+        return [(commit['id'], '{}\n{}'.format(repository, commit['id']))
+                for commit in body.get('commits') or ()]
+
+    def render(self, body, trace=None):
+        """Return list of messages and digest entries for push"""
+        started = time.perf_counter()
+        routed = response.route_push(
+            body, self._rules, self._slack_username, self._slack_channel)
+        APPLY_RULES_SECONDS.observe(time.perf_counter() - started)
+        if trace is not None:
+            trace.mark('rules')
+        if routed is None:
+            return []
+
+        push, outcome = routed
+        if outcome.digest is not None:
+            if push['deleted'] or not push['commits']:
+                return []
+            return [DigestEntry.from_push(
+                push, outcome.branch, outcome.username, outcome.channel,
+                outcome.digest)]
+
+        seen_commits = None
+        if self._seen is not None:
+            commit_keys = self._commit_keys(body)
+            seen_commits = {commit_id for commit_id, key in commit_keys
+                            if key in self._seen}
+
+        started = time.perf_counter()
+        slack_message = response.message_from_push(
+            push, outcome.username, outcome.channel,
+            seen_commits=seen_commits, **self._message_options)
+        RENDER_SECONDS.observe(time.perf_counter() - started)
+        if trace is not None:
+            trace.mark('rendered')
+        if slack_message is None:
+            return []
+
+        if seen_commits is not None:
+            for _, key in commit_keys:
+                self._seen.add(key)
+        return [slack_message]
+
+
+class PushHandler(object):
+    """AMQP consumer callback turning Git pushes into Slack messages
+
+    A push is acknowledged when the messages it resulted in have been
+    delivered to Slack, or right away if it did not result in any.
+    Delivered pushes are acknowledged by ack_delivered(), which must be
+    called from the thread that consumes, since the AMQP channel is not
+    thread safe.
+
+    Pushes seen before, e.g. redelivered by the broker or resent by the
+    Git server, are acknowledged and dropped before rules are applied.
+    A push is only remembered across restarts once it has been handled,
+    so that pushes lost from the queue are still posted when redelivered.
+
+    Pushes routed to a digest are acknowledged when they are added to
+    it, which only survives a restart if slack.spool_dir is configured.
+    Digests whose window has ended are enqueued by flush_digests(),
+    which must be called regularly, and by close().
+
+    reload() replaces the rules, message settings and tracing while
+    pushes are being consumed.
+    """
+    def __init__(self, hook, config):
+        self._hook = hook
+        self._config = config
+        self._renderer = PushRenderer(config)
+        self._dedupe = create_dedupe(config)
+        self._digests = create_digests(config)
+
+        # Tracing of a sample of pushes
+        self._tracer = create_tracer(config)
+
+        self._delivered = deque()
+
+    def reload(self, config):
+        """Use rules, message settings and tracing of new configuration
+
+        The new settings are built before they replace the current ones,
+        which are kept if the configuration is invalid. Raises
+        ConfigError or RulesError in that case.
+        """
+        renderer = PushRenderer(config, self._renderer)
+        tracer = create_tracer(config)
+        self._swap(config, renderer, tracer)
+
+    def _swap(self, config, renderer, tracer):
+        for change in restart_changes(self._config, config):
+            log.warning('restart_required',
+                        'Change of {setting} takes effect after a restart',
+                        setting=change)
+        self._renderer = renderer
+        self._tracer = tracer
+        self._config = config
+
+    def _start_trace(self, body):
+        if self._tracer is None or not isinstance(body, dict):
+            return None
+        repository = body.get('repository')
+        return self._tracer.start(
+            repository=(repository.get('full_name')
+                        if isinstance(repository, dict) else None),
+            ref=body.get('ref'), after=body.get('after'))
+
+    def ack_delivered(self):
+        while self._delivered:
+            self._delivered.popleft().ack()
+
+    def _is_duplicate(self, key, message):
+        """Acknowledge push and return True if it was seen before"""
+        if self._dedupe is None or key is None or self._dedupe.add(key):
+            return False
+        DUPLICATE_PUSHES.inc()
+        log.info('duplicate', 'Dropping duplicate push to {repository}'
+                 ' {ref} {after}', repository=key[0], ref=key[1],
+                 after=key[3])
+        message.ack()
+        return True
+
+    def _handled(self, key):
+        if self._dedupe is not None and key is not None:
+            self._dedupe.confirm(key)
+
+    def _on_delivered(self, message, key):
+        self._handled(key)
+        self._delivered.append(message)
+
+    def flush_digests(self, flush=False):
+        """Enqueue digests whose window has ended, or all if flush"""
+        for digest_message, spool_ids in self._digests.due(flush):
+            if self._hook is not None:
+                self._hook.enqueue(digest_message)
+            # The spool of the hook keeps the message from now on
+            self._digests.enqueued(spool_ids)
+
+    def _enqueue(self, messages, message, trace, key=None):
+        """Enqueue Slack messages for push and return True if any
+
+        Digest entries among the messages are added to their digest.
+        """
+        entries = [m for m in messages if isinstance(m, DigestEntry)]
+        if entries:
+            for entry in entries:
+                self._digests.add(entry)
+            messages = [m for m in messages
+                        if not isinstance(m, DigestEntry)]
+        if self._hook is None or not messages:
+            self._handled(key)
+            if trace is not None:
+                trace.finish('digest' if entries else 'no_message')
+            return False
+        for slack_message in messages:
+            self._hook.enqueue(slack_message,
+                               partial(self._on_delivered, message, key),
+                               trace)
+        return True
+
+    def __call__(self, body, message):
+        PUSHES.inc()
+        key = push_key(body)
+        if self._is_duplicate(key, message):
+            return
+        trace = self._start_trace(body)
+        messages = []
+        try:
+            messages = self._renderer.render(body, trace)
+        except:
+            PUSH_ERRORS.inc()
+            log.warning('push_error', 'Unable to process push:',
+                        exc_info=True)
+
+        # Acknowledge when delivered if the push resulted in a message
+        if not self._enqueue(messages, message, trace, key):
+            message.ack()
+
+    def close(self):
+        self.flush_digests(True)
+        self._digests.close()
+        if self._dedupe is not None:
+            self._dedupe.save()
+
+
+def shard(body, count):
+    """Return shard of push among count shards
+
+    Pushes are sharded by repository, so that the pushes to a
+    repository stay in order.
+    """
+    try:
+        repository = body['repository']['full_name']
+    except (KeyError, TypeError):
+        repository = ''
+    return zlib.crc32(str(repository).encode()) % count
+
+
+def _item_document(item):
+    """Return document of rendered message or digest entry"""
+    if isinstance(item, DigestEntry):
+        return {'digest': item.document()}
+    return {'message': item.document(), 'origin': item.origin.document()}
+
+
+def _item_from_document(doc):
+    if 'digest' in doc:
+        return DigestEntry.from_document(doc['digest'])
+    return slack.Message.from_document(
+        doc['message'], response.PushOrigin.from_document(doc['origin']))
+
+
+def _render_worker(config, tasks, results):
+    """Render pushes from tasks queue in worker process"""
+    # The supervisor handles interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    renderer = PushRenderer(config)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        number, body = task
+        if number is None:
+            # Reloaded configuration, validated by the supervisor; keep
+            # the current renderer if it fails here anyway
+            try:
+                renderer = PushRenderer(body, renderer)
+            except Exception:
+                log.error('reload_failed', 'Worker could not reload'
+                          ' configuration:\n{error}',
+                          error=traceback.format_exc())
+            continue
+        try:
+            documents = [_item_document(item)
+                         for item in renderer.render(body)]
+        except Exception:
+            results.put((number, [], traceback.format_exc()))
+        else:
+            results.put((number, documents, None))
+
+
+class ShardedPushHandler(PushHandler):
+    """AMQP consumer callback rendering pushes in worker processes
+
+    Pushes are dispatched to one of a number of worker processes by
+    shard() and the rendered messages are enqueued to the hook by a
+    collector thread. Each worker renders its pushes in order, so
+    messages for a repository are enqueued in the order the pushes
+    arrived. All messages go through the single hook of this process
+    and thus share its rate limits. A reloaded configuration is passed
+    to the workers in line with the pushes, so each push is rendered
+    with the configuration current when it arrived.
+
+    Workers that die are restarted and the pushes they had not rendered
+    yet are dispatched again. A push that was pending when its worker
+    died a second time is given up on like a push that failed to render.
+    """
+    def __init__(self, hook, config, workers):
+        super(ShardedPushHandler, self).__init__(hook, config)
+        self._config = config
+        self._context = multiprocessing.get_context('spawn')
+        self._tasks = [self._context.Queue() for _ in range(workers)]
+        self._results = self._context.Queue()
+        self._processes = [self._start_worker(i) for i in range(workers)]
+        # Pushes dispatched to the workers by number, and the lock
+        # guarding them and the task queues
+        self._pending = {}
+        self._number = 0
+        self._lock = Lock()
+        self._running = True
+        self._collector = Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=_render_worker,
+            args=(self._config, self._tasks[index], self._results))
+        process.daemon = True
+        process.start()
+        return process
+
+    def _dispatch(self, index, body, pending):
+        """Queue push to worker; the lock must be held"""
+        self._number += 1
+        self._pending[self._number] = (index, body) + pending
+        self._tasks[index].put((self._number, body))
+
+    def _check_workers(self):
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or not self._running:
+                continue
+            log.error('worker_died', 'Worker {index} exited with code'
+                      ' {code}; restarting', index=index,
+                      code=process.exitcode)
+            given_up = []
+            with self._lock:
+                # Pushes left in the old queue are dispatched again under
+                # new numbers, so late results of the dead worker are
+                # ignored
+                self._tasks[index].cancel_join_thread()
+                self._tasks[index] = self._context.Queue()
+                for number in sorted(self._pending):
+                    if self._pending[number][0] != index:
+                        continue
+                    _, body, message, trace, key, attempts = (
+                        self._pending.pop(number))
+                    if attempts:
+                        given_up.append((message, trace, key))
+                    else:
+                        self._dispatch(index, body,
+                                       (message, trace, key, attempts + 1))
+                self._processes[index] = self._start_worker(index)
+
+            for message, trace, key in given_up:
+                PUSH_ERRORS.inc()
+                log.warning('push_error', 'Giving up on push that was'
+                            ' pending when worker {index} died',
+                            index=index)
+                # Let the push be processed if it is sent again
+                if self._dedupe is not None and key is not None:
+                    self._dedupe.discard(key)
+                if trace is not None:
+                    trace.finish('no_message')
+                self._delivered.append(message)
+
+    def reload(self, config):
+        # Validate the whole configuration here before the workers,
+        # and workers restarted later, build their renderer from it
+        renderer = PushRenderer(config, self._renderer)
+        tracer = create_tracer(config)
+        with self._lock:
+            for tasks in self._tasks:
+                tasks.put((None, config))
+            self._swap(config, renderer, tracer)
+
+    def __call__(self, body, message):
+        PUSHES.inc()
+        key = push_key(body)
+        if self._is_duplicate(key, message):
+            return
+        trace = self._start_trace(body)
+        if trace is not None:
+            trace.mark('dispatched')
+        with self._lock:
+            self._dispatch(shard(body, len(self._tasks)), body,
+                           (message, trace, key, 0))
+
+    def _collect(self):
+        checked = time.monotonic()
+        while self._running:
+            if time.monotonic() - checked >= 1:
+                self._check_workers()
+                checked = time.monotonic()
+            try:
+                number, documents, error = self._results.get(timeout=1)
+            except Empty:
+                continue
+
+            with self._lock:
+                pending = self._pending.pop(number, None)
+            if pending is None:
+                # Dispatched again after its worker died
+                continue
+            _, _, message, trace, key, _ = pending
+            if error is not None:
+                PUSH_ERRORS.inc()
+                log.warning('push_error', 'Unable to process push:\n'
+                            '{error}', error=error)
+            if trace is not None:
+                trace.mark('rendered')
+            messages = [_item_from_document(document)
+                        for document in documents]
+            if not self._enqueue(messages, message, trace, key):
+                # Acknowledged from the consuming thread
+                self._delivered.append(message)
+
+    def close(self):
+        """Stop worker processes"""
+        # Stop the collector first so that exiting workers are not
+        # restarted
+        self._running = False
+        self._collector.join()
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(5)
+        super(ShardedPushHandler, self).close()
+
+
+def configure_logging(config):
+    """Configure logging from logging section of configuration"""
+    options = config.get('logging') or {}
+    log_format = options.get('format', 'text')
+    if log_format not in ('text', 'json'):
+        raise ConfigError('Invalid log format: {}'.format(log_format))
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(StructuredFormatter())
+    logging.basicConfig(level=options.get('level', 'INFO'),
+                        handlers=[handler])
+    configure_events(options.get('events'))
+
+
+class ConfigReloader(Thread):
+    """Thread reloading the configuration file of a running daemon
+
+    The file is reloaded when its modification time or size changes,
+    checked every interval seconds (never if interval is 0), or when
+    request() is called, e.g. from a SIGHUP handler. The new
+    configuration is loaded and validated in this thread and then
+    passed to the reload() method of the push handler, so consuming is
+    not interrupted. An invalid configuration is logged and ignored.
+    """
+    def __init__(self, path, handler, interval=5.0):
+        Thread.__init__(self)
+        self.daemon = True
+        self._path = path
+        self._handler = handler
+        self._interval = interval
+        self._requested = Event()
+        self._running = True
+        self._version = self._file_version()
+
+    def _file_version(self):
+        try:
+            info = os.stat(self._path)
+        except OSError:
+            return None
+        return info.st_mtime_ns, info.st_size
+
+    def request(self):
+        """Reload the configuration soon"""
+        self._requested.set()
+
+    def stop(self):
+        self._running = False
+        self._requested.set()
+
+    def run(self):
+        while self._running:
+            requested = self._requested.wait(self._interval or None)
+            if not self._running:
+                break
+            self._requested.clear()
+            version = self._file_version()
+            if requested or (version is not None and
+                             version != self._version):
+                self._version = version
+                self.reload()
+
+    def reload(self):
+        """Reload configuration and return True if it was applied"""
+        try:
+            config = load_config(self._path)
+            self._handler.reload(config)
+        except Exception as e:
+            CONFIG_RELOADS.labels('error').inc()
+            log.error('reload_failed', 'Configuration {path} not reloaded:'
+                      ' {error}', path=self._path, error=e)
+            return False
+
+        options = config.get('logging') or {}
+        logging.getLogger().setLevel(options.get('level', 'INFO'))
+        configure_events(options.get('events'))
+        CONFIG_RELOADS.labels('ok').inc()
+        log.info('reload', 'Reloaded configuration {path}', path=self._path)
+        return True
+
+
+def git_queue():
+    """Return AMQP queue receiving all Git push messages"""
+    git_exchange = Exchange('git', type='topic', durable=False)
+    return Queue(exchange=git_exchange, routing_key='#', exclusive=True)
+
+
+def run(config, stop=None, config_path=None):
+    """Consume Git push messages until interrupted
+
+    If stop is given, e.g. a threading.Event, consuming also ends when
+    it is set. If config_path is given, the configuration is reloaded
+    from it when the file changes or, when run from the main thread, on
+    SIGHUP. Raises ConfigError or RulesError if the configuration is
+    invalid.
+    """
+    hook, hook_spool = create_hook(config)
+    try:
+        # Render pushes in worker processes if configured
+        workers = config.get('workers', 1)
+        if workers > 1:
+            handler = ShardedPushHandler(hook, config, workers)
+        else:
+            handler = PushHandler(hook, config)
+    except:
+        if hook_spool is not None:
+            hook_spool.close()
+        raise
+
+    # Number of unacknowledged messages the broker will send us
+    prefetch_count = config.get('amqp', {}).get('prefetch_count', 100)
+
+    metrics_server = None
+    if 'metrics' in config:
+        metrics_server = MetricsServer(
+            config['metrics'].get('port', 9100),
+            config['metrics'].get('address', '127.0.0.1'))
+        metrics_server.start()
+        logger.info('Serving metrics on port {}'.format(
+            metrics_server.port))
+
+    if hook is not None:
+        QUEUE_DEPTH.set_function(lambda: hook.health()['queued'])
+        hook.start()
+
+    reloader = None
+    if config_path is not None:
+        reloader = ConfigReloader(config_path, handler,
+                                  config.get('reload_interval', 5.0))
+        reloader.start()
+        if (hasattr(signal, 'SIGHUP') and
+                current_thread() is main_thread()):
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: reloader.request())
+
+    logger.info("Waiting for Git push messages...")
+
+    try:
+        transport_options = config.get('amqp', {}).get('transport_options')
+        with Connection(amqp_url(config),
+                        transport_options=transport_options) as connection:
+            with Consumer(connection, git_queue(), accept=['json'],
+                          callbacks=[handler],
+                          prefetch_count=prefetch_count):
+                try:
+                    # Wake up regularly so that delivered pushes are
+                    # acknowledged while no new pushes arrive
+                    while stop is None or not stop.is_set():
+                        try:
+                            connection.drain_events(timeout=1)
+                        except socket.timeout:
+                            pass
+                        handler.ack_delivered()
+                        handler.flush_digests()
+                except KeyboardInterrupt:
+                    pass
+            logger.info('Closing AMQP connection...')
+    finally:
+        if reloader is not None:
+            reloader.stop()
+            reloader.join()
+        handler.close()
+        if hook is not None:
+            logger.info('Stopping Slack WebHook connector...')
+            hook.stop()
+            hook.join()
+        if hook_spool is not None:
+            hook_spool.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+
+    logger.info('Done.')
+
+
+def main(argv=None):
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Post Git push information from AMQP to Slack')
+    parser.add_argument('--config', metavar='file',
+                        help='Configuration file')
+    args = parser.parse_args(argv)
+
+    # Load configuration file
+    config = load_config(args.config) if args.config else {}
+
+    try:
+        configure_logging(config)
+        run(config, config_path=args.config)
+    except ConfigError as e:
+        parser.error(str(e))
+    except response.RulesError as e:
+        parser.error('Invalid rules in configuration: {}'.format(e))
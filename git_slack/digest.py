@@ -0,0 +1,255 @@
+
+"""Periodic digests of the pushes routed to a channel"""
+
+import time
+import logging
+from threading import Lock
+
+from git_slack import slack
+from git_slack.metrics import Counter
+from git_slack.log import EventLog
+
+logger = logging.getLogger(__name__)
+log = EventLog(logger)
+
+
+DIGEST_PUSHES = Counter('git_slack_digest_pushes',
+                        'Pushes added to a digest instead of being posted')
+DIGESTS = Counter('git_slack_digests', 'Digest messages posted')
+
+
+_PRETEXT = slack.MarkupTemplate('Digest of the last {}: {} in {}')
+_BRANCH_LINE = slack.MarkupTemplate('[{}:{}] {} in {}')
+_MORE_BRANCHES = slack.MarkupTemplate('\u2026 {} not shown')
+_AUTHORS = slack.MarkupTemplate('Top authors: {}')
+_AUTHOR = slack.MarkupTemplate('{} ({:,})')
+
+
+def _count(count, noun, plural=None):
+    if count == 1:
+        return 'one {}'.format(noun)
+    return '{:,} {}'.format(count, plural or noun + 's')
+
+
+def format_window(seconds):
+    """Return digest window as text, e.g. '5 minutes' or 'hour'"""
+    for unit, size in (('day', 86400), ('hour', 3600), ('minute', 60)):
+        if seconds >= size and seconds % size == 0:
+            count = int(seconds // size)
+            return unit if count == 1 else '{} {}s'.format(count, unit)
+    if seconds == int(seconds):
+        seconds = int(seconds)
+    return 'second' if seconds == 1 else '{:g} seconds'.format(seconds)
+
+
+class DigestEntry(object):
+    """Contribution of a push to the digest of a channel"""
+    __slots__ = ('repository', 'branch', 'commits', 'authors', 'username',
+                 'channel', 'window')
+
+    def __init__(self, repository, branch, commits, authors, username,
+                 channel, window):
+        self.repository = repository
+        self.branch = branch
+        self.commits = commits
+        self.authors = authors
+        self.username = username
+        self.channel = channel
+        self.window = window
+
+    @classmethod
+    def from_push(cls, push, branch, username, channel, window):
+        """Return entry of push to branch, counting its commits"""
+        authors = {}
+        for commit in push['commits']:
+            name = commit['author']['name']
+            authors[name] = authors.get(name, 0) + 1
+        return cls(push['repository']['full_name'], branch,
+                   len(push['commits']), authors, username, channel, window)
+
+    @property
+    def key(self):
+        return self.channel, self.username, self.window
+
+    def document(self):
+        return {'repository': self.repository, 'branch': self.branch,
+                'commits': self.commits, 'authors': self.authors,
+                'username': self.username, 'channel': self.channel,
+                'window': self.window}
+
+    @classmethod
+    def from_document(cls, doc):
+        return cls(**doc)
+
+
+class TopCounts(object):
+    """Approximate counts of the most frequent keys
+
+    At most size keys are counted (the Space-Saving algorithm). A new key
+    takes the place of the key with the lowest count and starts from
+    that count, so the counts of frequent keys are never too low and
+    only overestimated by at most the lowest count.
+    """
+    def __init__(self, size=20):
+        self._size = size
+        self._counts = {}
+
+    def add(self, key, count=1):
+        counts = self._counts
+        if key not in counts and len(counts) >= self._size:
+            lowest = min(counts, key=counts.get)
+            counts[key] = counts.pop(lowest)
+        counts[key] = counts.get(key, 0) + count
+
+    def most_common(self, n):
+        """Return list of up to n keys and counts, most frequent first"""
+        return sorted(self._counts.items(),
+                      key=lambda item: (-item[1], item[0]))[:n]
+
+
+class Digest(object):
+    """Summary of the pushes to a channel during a window
+
+    Counts pushes and commits per repository and branch and the commits
+    of the most frequent authors, so its size does not depend on the
+    number of commits.
+    """
+    def __init__(self, channel, username, window, due, max_branches=50,
+                 top_authors=5):
+        self.channel = channel
+        self.username = username
+        self.window = window
+        self.due = due
+        self.pushes = 0
+        self.commits = 0
+        self._branches = {}
+        self._authors = TopCounts(4 * top_authors)
+        self._max_branches = max_branches
+        self._top_authors = top_authors
+        # Spool entries of the pushes in the digest
+        self.spool_ids = []
+
+    def add(self, entry):
+        self.pushes += 1
+        self.commits += entry.commits
+        counts = self._branches.setdefault(
+            (entry.repository, entry.branch), [0, 0])
+        counts[0] += 1
+        counts[1] += entry.commits
+        for name, count in entry.authors.items():
+            self._authors.add(name, count)
+
+    def message(self):
+        """Return digest as Slack message"""
+        commits = _count(self.commits, 'commit')
+        pushes = _count(self.pushes, 'push', 'pushes')
+        pretext = _PRETEXT.format(format_window(self.window), commits,
+                                  pushes)
+
+        branches = sorted(self._branches.items(),
+                          key=lambda item: (-item[1][1], item[0]))
+        lines = [_BRANCH_LINE.format(repository, branch,
+                                     _count(commits, 'commit'),
+                                     _count(pushes, 'push', 'pushes'))
+                 for (repository, branch), (pushes, commits)
+                 in branches[:self._max_branches]]
+        if len(branches) > self._max_branches:
+            lines.append(_MORE_BRANCHES.format(_count(
+                len(branches) - self._max_branches, 'branch', 'branches')))
+
+        authors = self._authors.most_common(self._top_authors)
+        if authors:
+            lines.append(_AUTHORS.format(slack.Markup(', ').join(
+                _AUTHOR.format(name, count) for name, count in authors)))
+
+        attachment = slack.Attachment(
+            fallback='Digest: {} in {}'.format(commits, pushes),
+            pretext=pretext,
+            color='#4183c4', text=slack.Markup('\n').join(lines))
+        return slack.Message(attachments=[attachment],
+                             username=self.username, channel=self.channel)
+
+
+class DigestCollector(object):
+    """Collects digest entries per channel until their window ends
+
+    The window of a digest starts with its first push. due() returns the
+    messages of the digests whose window has ended; it should be called
+    regularly. The collector is safe to use from multiple threads.
+
+    Digests are only kept in memory unless a Spool is given. Entries are
+    then written to it when added, and marked as delivered by enqueued()
+    once the message of their digest has been handed on; entries left in
+    the spool by a previous run are added again, keeping the time their
+    window ends.
+    """
+    def __init__(self, max_branches=50, top_authors=5, clock=None,
+                 spool=None):
+        self._max_branches = max_branches
+        self._top_authors = top_authors
+        self._clock = time.monotonic if clock is None else clock
+        self._spool = spool
+        self._digests = {}
+        self._lock = Lock()
+
+        if spool is not None:
+            pending = spool.pending()
+            if pending:
+                log.info('digest_replay', 'Replaying {count} spooled digest'
+                         ' entries', count=len(pending))
+            for entry_id, doc in pending:
+                entry = DigestEntry.from_document(doc['entry'])
+                age = max(0.0, time.time() - doc['time'])
+                self._add(entry, entry_id, age)
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, entry):
+        DIGEST_PUSHES.inc()
+        entry_id = None
+        if self._spool is not None:
+            entry_id = self._spool.append({'entry': entry.document(),
+                                           'time': time.time()})
+        self._add(entry, entry_id)
+
+    def _add(self, entry, entry_id, age=0.0):
+        with self._lock:
+            digest = self._digests.get(entry.key)
+            if digest is None:
+                digest = Digest(entry.channel, entry.username, entry.window,
+                                self._clock() + entry.window - age,
+                                self._max_branches, self._top_authors)
+                self._digests[entry.key] = digest
+            digest.add(entry)
+            if entry_id is not None:
+                digest.spool_ids.append(entry_id)
+
+    def due(self, flush=False):
+        """Remove digests whose window has ended and return messages
+
+        Returns a list of message and spool entry IDs of each digest. If
+        flush is true, all digests are returned.
+        """
+        now = self._clock()
+        with self._lock:
+            due = [key for key, digest in self._digests.items()
+                   if flush or digest.due <= now]
+            digests = [self._digests.pop(key) for key in due]
+
+        messages = []
+        for digest in digests:
+            DIGESTS.inc()
+            log.info('digest', 'Digest of {pushes} pushes to {channel}',
+                     pushes=digest.pushes, channel=digest.channel)
+            messages.append((digest.message(), digest.spool_ids))
+        return messages
+
+    def enqueued(self, spool_ids):
+        """Mark spool entries of a digest whose message was enqueued"""
+        for entry_id in spool_ids:
+            self._spool.mark_delivered(entry_id)
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
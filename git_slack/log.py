@@ -0,0 +1,131 @@
+
+"""Structured logging of events with lazy formatting and sampling"""
+
+import json
+import time
+import random
+import logging
+from threading import Lock
+
+from git_slack.ratelimit import TokenBucket
+
+
+class _Event(object):
+    """Log message that is formatted when a handler emits it
+
+    Field values that are callable are called at that time, so that
+    expensive values are only computed for records that are emitted.
+    """
+    __slots__ = ('name', 'template', '_fields', '_values')
+
+    def __init__(self, name, template, fields):
+        self.name = name
+        self.template = template
+        self._fields = fields
+        self._values = None
+
+    @property
+    def fields(self):
+        if self._values is None:
+            self._values = {key: value() if callable(value) else value
+                            for key, value in self._fields.items()}
+        return self._values
+
+    def __str__(self):
+        return self.template.format(**self.fields)
+
+
+class _EventSettings(object):
+    """Sampling and rate cap of an event"""
+    def __init__(self, sample=1.0, max_rate=None, burst=1):
+        self.sample = sample
+        self.bucket = (TokenBucket(max_rate, burst)
+                       if max_rate is not None else None)
+        self.suppressed = 0
+        self.lock = Lock()
+
+    def admit(self):
+        """Return number of suppressed events if event is logged"""
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return None
+        if self.bucket is None:
+            return 0
+        with self.lock:
+            if not self.bucket.consume(time.monotonic()):
+                self.suppressed += 1
+                return None
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+
+_settings = {}
+
+
+def configure_events(events):
+    """Set sampling and rate caps from mapping of event name to settings
+
+    The settings of an event are sample, the fraction of events that are
+    logged, and max_rate and burst which cap the number of events logged
+    per second. Events without settings are always logged.
+    """
+    settings = {}
+    for name, options in (events or {}).items():
+        options = options or {}
+        settings[name] = _EventSettings(options.get('sample', 1.0),
+                                        options.get('max_rate'),
+                                        options.get('burst', 1))
+    _settings.clear()
+    _settings.update(settings)
+
+
+class EventLog(object):
+    """Logs named events through a standard logger
+
+    Nothing is formatted unless the logger is enabled for the level and
+    the event passes its sampling and rate cap (see configure_events).
+    The event is attached to the log record as its event attribute for
+    use by StructuredFormatter.
+    """
+    def __init__(self, logger):
+        self._logger = logger
+
+    def log(self, level, event, template, exc_info=False, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        settings = _settings.get(event)
+        if settings is not None:
+            suppressed = settings.admit()
+            if suppressed is None:
+                return
+            if suppressed:
+                fields['suppressed'] = suppressed
+        record = _Event(event, template, fields)
+        self._logger.log(level, record, exc_info=exc_info,
+                         extra={'event': record})
+
+    def debug(self, event, template, **fields):
+        self.log(logging.DEBUG, event, template, **fields)
+
+    def info(self, event, template, **fields):
+        self.log(logging.INFO, event, template, **fields)
+
+    def warning(self, event, template, **fields):
+        self.log(logging.WARNING, event, template, **fields)
+
+    def error(self, event, template, **fields):
+        self.log(logging.ERROR, event, template, **fields)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats log records as JSON objects, one per line"""
+    def format(self, record):
+        doc = {'time': record.created, 'level': record.levelname,
+               'logger': record.name, 'message': record.getMessage()}
+        event = getattr(record, 'event', None)
+        if isinstance(event, _Event):
+            doc['event'] = event.name
+            doc.update((key, value) for key, value in event.fields.items()
+                       if key not in doc)
+        if record.exc_info:
+            doc['exception'] = self.formatException(record.exc_info)
+        return json.dumps(doc, default=str)
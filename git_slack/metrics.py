@@ -0,0 +1,305 @@
+
+"""Counters, gauges and histograms exposed in Prometheus text format"""
+
+import math
+from bisect import bisect_left
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    elif value == math.inf:
+        return '+Inf'
+    elif value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape_label(value))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Registry(object):
+    """Set of metrics that are exposed together"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('Metric {} is already registered'.format(
+                    metric.name))
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def exposition(self):
+        """Return metrics in Prometheus text format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(
+                metric.family, metric.documentation.replace('\n', ' ')))
+            lines.append('# TYPE {} {}'.format(metric.family, metric.type))
+            for suffix, names, values, value in metric.samples():
+                lines.append('{}{}{} {}'.format(
+                    metric.name, suffix, _format_labels(names, values),
+                    _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# Registry of the metrics of the daemon
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    """Metric with a value for each combination of label values
+
+    Values are obtained with labels(); a metric without labels has a
+    single value which is updated through the metric itself.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._children = {}
+        (REGISTRY if registry is None else registry).register(self)
+        self._value = None if self.labelnames else self.labels()
+
+    @property
+    def family(self):
+        """Name of the metric in HELP and TYPE lines"""
+        return self.name
+
+    def labels(self, *values):
+        """Return value for label values"""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('Metric {} has labels {}'.format(
+                    self.name, ', '.join(self.labelnames)))
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Yield name suffix, label names, label values and value"""
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            for suffix, names, extra, value in child.samples():
+                yield (suffix, self.labelnames + names, values + extra,
+                       value)
+
+
+class _CounterValue(object):
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield '_total', (), (), self.value
+
+
+class Counter(_Metric):
+    """Monotonically increasing count
+
+    The name should not include the _total suffix, which is added when
+    the counter is exposed.
+    """
+    type = 'counter'
+
+    @property
+    def family(self):
+        # As prometheus_client, so the TYPE line matches the samples
+        return self.name + '_total'
+
+    def _child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._value.inc(amount)
+
+    @property
+    def value(self):
+        return self._value.value
+
+
+class _GaugeValue(object):
+    __slots__ = ('_lock', '_value', '_function')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Take value from function when the gauge is read"""
+        self._function = function
+
+    @property
+    def value(self):
+        function = self._function
+        return self._value if function is None else function()
+
+    def samples(self):
+        yield '', (), (), self.value
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    type = 'gauge'
+
+    def _child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._value.set(value)
+
+    def inc(self, amount=1):
+        self._value.inc(amount)
+
+    def dec(self, amount=1):
+        self._value.dec(amount)
+
+    def set_function(self, function):
+        self._value.set_function(function)
+
+    @property
+    def value(self):
+        return self._value.value
+
+
+class _HistogramValue(object):
+    __slots__ = ('_lock', '_bounds', '_counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self._lock = Lock()
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self._bounds + (math.inf,), counts):
+            cumulative += bucket_count
+            yield '_bucket', ('le',), (_format_value(bound),), cumulative
+        yield '_sum', (), (), total
+        yield '_count', (), (), count
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        self._bounds = tuple(sorted(float(b) for b in buckets
+                                    if b != math.inf))
+        super(Histogram, self).__init__(name, documentation, labelnames,
+                                        registry)
+
+    def _child(self):
+        return _HistogramValue(self._bounds)
+
+    def observe(self, value):
+        self._value.observe(value)
+
+    @property
+    def count(self):
+        return self._value.count
+
+    @property
+    def sum(self):
+        return self._value.sum
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(object):
+    """HTTP server exposing metrics on /metrics in a background thread"""
+    def __init__(self, port, address='127.0.0.1', registry=None):
+        self._server = ThreadingHTTPServer((address, port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = REGISTRY if registry is None else registry
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
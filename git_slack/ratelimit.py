@@ -0,0 +1,97 @@
+
+"""Rate limiting of Slack messages"""
+
+import time
+from threading import Lock
+
+
+class TokenBucket(object):
+    """Token bucket that refills at rate tokens per second up to burst
+
+    A bucket can additionally be blocked for a period of time, e.g. when
+    the server asks us to back off.
+    """
+    def __init__(self, rate, burst=1, now=None):
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+        if burst < 1:
+            raise ValueError('Burst size must be at least one')
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic() if now is None else now
+        self._blocked_until = 0.0
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._updated) * self._rate)
+            self._updated = now
+
+    def wait_time(self, now):
+        """Return seconds until a token is available"""
+        self._refill(now)
+        wait = max(0.0, (1.0 - self._tokens) / self._rate)
+        return max(wait, self._blocked_until - now)
+
+    def consume(self, now):
+        """Take a token and return True if one is available"""
+        if self.wait_time(now) > 0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+    def block(self, seconds, now):
+        """Block bucket for a number of seconds and drain it"""
+        self._refill(now)
+        self._tokens = 0.0
+        self._blocked_until = max(self._blocked_until, now + seconds)
+
+    def idle(self, now):
+        """Return True if bucket is full and not blocked"""
+        self._refill(now)
+        return self._tokens >= self._burst and self._blocked_until <= now
+
+
+class RateLimiter(object):
+    """Set of token buckets keyed by e.g. channel
+
+    Buckets are created on demand. Idle buckets are indistinguishable
+    from new ones and are discarded when the number of buckets grows
+    past max_buckets. The limiter is safe to use from multiple threads.
+    """
+    def __init__(self, rate, burst=1, max_buckets=1024, clock=None):
+        self._rate = rate
+        self._burst = burst
+        self._max_buckets = max_buckets
+        self._clock = time.monotonic if clock is None else clock
+        self._buckets = {}
+        self._lock = Lock()
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._max_buckets:
+                self._buckets = {k: b for k, b in self._buckets.items()
+                                 if not b.idle(now)}
+            bucket = TokenBucket(self._rate, self._burst, now)
+            self._buckets[key] = bucket
+        return bucket
+
+    def wait_time(self, key):
+        """Return seconds until a message for key can be sent"""
+        with self._lock:
+            now = self._clock()
+            return self._bucket(key, now).wait_time(now)
+
+    def consume(self, key):
+        """Take a token for key and return True if available"""
+        with self._lock:
+            now = self._clock()
+            return self._bucket(key, now).consume(now)
+
+    def block(self, key, seconds):
+        """Block key for a number of seconds"""
+        with self._lock:
+            now = self._clock()
+            self._bucket(key, now).block(seconds, now)
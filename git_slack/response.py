@@ -3,110 +3,315 @@
 
 import re
 import logging
+from collections.abc import Mapping, Sequence
+from itertools import islice
 
 from git_slack import slack
+from git_slack.rules import RuleSet, RulesError
+from git_slack.metrics import Counter
+from git_slack.log import EventLog
 
 logger = logging.getLogger(__name__)
+log = EventLog(logger)
 
 
-class RulesError(Exception):
-     """Error while applying rules"""
+RULE_MATCHES = Counter('git_slack_rule_matches',
+                       'Pushes that matched each rule', ['rule'])
+RULE_FILTERED = Counter('git_slack_rule_filtered',
+                        'Pushes filtered by each rule', ['rule'])
+
+
+_BRANCH_REF = re.compile(r'^refs/heads/(.*)$')
+
+_REMOVED = object()
+
+_PRETEXT = slack.MarkupTemplate('[{}:{}] {}:')
+_COMMIT_LINE = slack.MarkupTemplate('{}: {} - {}')
+_MORE_COMMITS = slack.MarkupTemplate('\u2026 and {:,} more')
+_SEEN_COMMITS = slack.MarkupTemplate('{} already announced')
+
+
+class _Overlay(Mapping):
+    """Read-only view of a mapping with some keys replaced or removed"""
+
+    def __init__(self, base, overrides):
+        self._base = base
+        self._overrides = overrides
+
+    def __getitem__(self, key):
+        value = self._overrides.get(key, self._base.get(key, _REMOVED))
+        if value is _REMOVED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._overrides.get(
+            key, self._base.get(key, _REMOVED)) is not _REMOVED
+
+    def __iter__(self):
+        for key in self._base:
+            if self._overrides.get(key) is not _REMOVED:
+                yield key
+        for key, value in self._overrides.items():
+            if key not in self._base and value is not _REMOVED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def _url_override(url):
+    return _REMOVED if url == '' else url
+
+
+class _CommitsView(Sequence):
+    """Commits of a push with URLs from rule outcome
+
+    A read-only sequence, not a list: convert it with list() to
+    concatenate or modify it. The overlay of a commit is created when it
+    is first read and the same overlay is returned afterwards.
+    """
+
+    def __init__(self, commits, outcome):
+        self._commits = commits
+        self._outcome = outcome
+        self._overlays = {}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        commit = self._commits[index]
+        if index < 0:
+            index += len(self._commits)
+        overlay = self._overlays.get(index)
+        if overlay is None:
+            overlay = self._overlays.setdefault(index, _Overlay(
+                commit, {'url': _url_override(
+                    self._outcome.format_commit_url(commit['id']))}))
+        return overlay
+
+    def __len__(self):
+        return len(self._commits)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+
+class PushView(_Overlay):
+    """Push with repository, branch and commit URLs overlaid by rules
+
+    The underlying push object is left untouched so it can be shared
+    between threads, and commit URLs are only formatted when the commits
+    are read.
+    """
+
+    def __init__(self, push, outcome):
+        overrides = {}
+        if outcome.branch_url is not None:
+            overrides['url'] = _url_override(outcome.branch_url)
+        if outcome.repository_url is not None:
+            overrides['repository'] = _Overlay(push['repository'], {
+                'url': _url_override(outcome.repository_url)})
+        if outcome.commit_url is not None and 'commits' in push:
+            overrides['commits'] = _CommitsView(push['commits'], outcome)
+        super(PushView, self).__init__(push, overrides)
+        self.outcome = outcome
 
 
 def apply_rules(push, rules, slack_username=None, slack_channel=None):
-    """Apply rules and yield push, username, channel to be sent"""
+    """Apply rules and yield push, username, channel to be sent
 
-    m = re.match(r'^refs/heads/(.*)$', push['ref'])
+    The rules can be given either as a compiled RuleSet or as a list of
+    rule mappings which is then compiled on each call. The push object
+    is not modified; if the rules change any URLs, the yielded push is a
+    PushView that overlays the changes.
+    """
+    routed = route_push(push, rules, slack_username, slack_channel)
+    if routed is not None:
+        push, outcome = routed
+        yield push, outcome.username, outcome.channel
+
+
+def route_push(push, rules, slack_username=None, slack_channel=None):
+    """Apply rules and return push and rule Outcome, or None if filtered
+
+    See apply_rules. The outcome also gives e.g. the digest window.
+    """
+
+    if not isinstance(rules, RuleSet):
+        rules = RuleSet(rules)
+
+    m = _BRANCH_REF.match(push['ref'])
     if not m:
-        logger.info('Push is not to a branch; no message generated.')
-        return
+        log.info('not_branch',
+                 'Push is not to a branch; no message generated.')
+        return None
 
     branch = m.group(1)
+    repo_name = push['repository']['full_name']
 
-    for rule_id, rule in enumerate(rules):
-        if ('filter' in rule and
-                rule['filter'] not in ('include', 'exclude')):
-            raise RulesError('Filter attribute of rule must be include'
-                             ' or exclude')
-
-        exclude = rule.get('filter', None) == 'exclude'
-        include = rule.get('filter', None) == 'include'
-
-        all_match = True
-
-        # Filter based on repository
-        if 'repository' in rule:
-            match = re.match(rule['repository']+r'\Z',
-                             push['repository']['full_name'])
-            all_match = match and all_match
-            if match and exclude or not match and include:
-                logger.info('Rule #{}: Filter based on repository'.format(
-                    rule_id))
-                return
-
-        # Filter based on branch
-        if 'branch' in rule:
-            match = re.match(rule['branch']+r'\Z', branch)
-            all_match = match and all_match
-            if match and exclude or not match and include:
-                logger.info('Rule #{}: Filter based on branch'.format(rule_id))
-                return
-
-        if all_match:
-            # Update Slack settings if matching
-            if 'username' in rule:
-                slack_username = rule['username']
-            if 'channel' in rule:
-                slack_channel = rule['channel']
-
-            # Update repository URL if matching
-            if 'repository_url' in rule:
-                repo_url = rule['repository_url'].format(
-                    repository=push['repository']['full_name'])
-                if repo_url != '':
-                    push['repository']['url'] = repo_url
-                else:
-                    push['repository'].pop('url', None)
-
-            # Update branch URL if matching
-            if 'branch_url' in rule:
-                branch_url = rule['branch_url'].format(
-                    repository=push['repository']['full_name'],
-                    branch=branch)
-                if branch_url != '':
-                    push['url'] = branch_url
-                else:
-                    push.pop('url', None)
-
-            # Update commit URLs if matching
-            if 'commit_url' in rule:
-                for commit in push['commits']:
-                    commit_url = rule['commit_url'].format(
-                        repository=push['repository']['full_name'],
-                        branch=branch, commit=commit['id'])
-                    if commit_url != '':
-                        commit['url'] = commit_url
-                    else:
-                        commit.pop('url', None)
-
-    yield push, slack_username, slack_channel
-
-
-def message_from_push(push, slack_username=None, slack_channel=None):
-    """Return response message from Git push object"""
+    outcome = rules.evaluate(repo_name, branch, slack_username,
+                             slack_channel)
+    if outcome.filtered:
+        RULE_FILTERED.labels(outcome.filtered_by).inc()
+        log.info('filtered', 'Rule #{rule}: Filter based on {reason}',
+                 rule=outcome.filtered_by, reason=outcome.filter_reason)
+        return None
+
+    for rule in outcome.rules:
+        RULE_MATCHES.labels(rule.rule_id).inc()
+
+    if (outcome.repository_url is not None or
+            outcome.branch_url is not None or
+            outcome.commit_url is not None):
+        push = PushView(push, outcome)
+
+    return push, outcome
+
+
+class PushOrigin(object):
+    """Push that a message was rendered from
+
+    Keeps the push and the options it was rendered with, so that the
+    message can be rendered again together with the commits of a later
+    push to the same branch. Of a large push, or one with seen commits,
+    only the commits that can be listed are kept, and the push has the
+    number of commits and of seen commits in commit_count and
+    seen_count.
+    """
+    __slots__ = ('push', 'username', 'channel', 'options', 'seen_commits')
+
+    def __init__(self, push, username=None, channel=None, options=None,
+                 seen_commits=()):
+        self.push = push
+        self.username = username
+        self.channel = channel
+        self.options = options or {}
+        self.seen_commits = frozenset(seen_commits)
+
+    @property
+    def key(self):
+        """Repository, ref and target of the message"""
+        return (self.push['repository']['full_name'], self.push['ref'],
+                self.username, self.channel)
+
+    @property
+    def forced(self):
+        return bool(self.push.get('forced'))
+
+    @property
+    def commit_count(self):
+        return self.push.get('commit_count', len(self.push['commits']))
+
+    @property
+    def seen_count(self):
+        return self.push.get('seen_count', len(self.seen_commits))
+
+    def document(self):
+        """Return origin as JSON document, keeping what is rendered"""
+        push = {key: self.push[key] for key in (
+            'ref', 'before', 'after', 'url', 'forced', 'created', 'deleted',
+            'commit_count', 'seen_count') if key in self.push}
+        repository = self.push['repository']
+        push['repository'] = {key: repository[key] for key in (
+            'full_name', 'url') if key in repository}
+        push['commits'] = []
+        for commit in self.push['commits']:
+            doc = {'id': commit['id'],
+                   'message': commit['message'].partition('\n')[0],
+                   'author': {'name': commit['author']['name']}}
+            if 'url' in commit:
+                doc['url'] = commit['url']
+            push['commits'].append(doc)
+        return {'push': push, 'username': self.username,
+                'channel': self.channel, 'options': self.options,
+                'seen_commits': sorted(self.seen_commits)}
+
+    @classmethod
+    def from_document(cls, doc):
+        """Return origin from document as returned by document()"""
+        return cls(doc['push'], doc['username'], doc['channel'],
+                   doc['options'], doc['seen_commits'])
+
+
+def _merged_url(url, before, new_before):
+    """Return URL of a push starting from before instead of new_before
+
+    A commit ID in the URL, e.g. of a comparison, is replaced, keeping
+    its abbreviation; URLs without it are returned unchanged.
+    """
+    m = re.search(re.escape(new_before[:7]) + '[0-9a-f]*', url)
+    if m is None or not new_before.startswith(m.group()):
+        return url
+    return url[:m.start()] + before[:len(m.group())] + url[m.end():]
+
+
+def supersede_message(message, other):
+    """Return message replacing a queued message and a later one
+
+    If other was rendered from a push to the same branch that continues
+    from the push of message, the returned message lists the commits of
+    both pushes and links to the changes from the first push on; if that
+    push was forced, other replaces message. Returns None if other does
+    not supersede message.
+    """
+    origin, new = message.origin, other.origin
+    if not isinstance(origin, PushOrigin) or not isinstance(new, PushOrigin):
+        return None
+    if origin.key != new.key or new.push['before'] != origin.push['after']:
+        return None
+    if new.forced:
+        return other
+
+    push = dict(new.push, before=origin.push['before'],
+                created=origin.push.get('created', False),
+                commits=(list(origin.push['commits']) +
+                         list(new.push['commits'])),
+                commit_count=origin.commit_count + new.commit_count,
+                seen_count=origin.seen_count + new.seen_count)
+    if 'url' in push:
+        push['url'] = _merged_url(push['url'], origin.push['before'],
+                                  new.push['before'])
+    return message_from_push(push, new.username, new.channel,
+                             seen_commits=(origin.seen_commits |
+                                           new.seen_commits),
+                             **new.options)
+
+
+def message_from_push(push, slack_username=None, slack_channel=None,
+                      max_commits=50, max_text_size=7000,
+                      seen_commits=None):
+    """Return response message from Git push object
+
+    At most max_commits commits are listed, using the first line of
+    each commit message, and the commit list is cut off before it grows
+    past max_text_size bytes. Commits that are left out are summarized
+    in a final line, so the cost of rendering does not depend on the
+    size of the push. Commits whose IDs are in seen_commits, e.g. merged
+    from a branch they were announced on, are only counted. The message
+    has the push as its PushOrigin, keeping only the commits that can be
+    listed and not seen; their total number is then taken from the
+    commit_count and seen_count keys of the push when it is rendered
+    again.
+    """
 
     # No messages on branch delete
     if push['deleted']:
-        logger.info('Push is a delete; no message generated.')
+        log.info('delete', 'Push is a delete; no message generated.')
         return None
 
-    m = re.match(r'^refs/heads/(.*)$', push['ref'])
+    m = _BRANCH_REF.match(push['ref'])
     if not m:
-        logger.info('Push is not to a branch; no message generated.')
+        log.info('not_branch',
+                 'Push is not to a branch; no message generated.')
         return None
 
-    if len(push['commits']) == 0:
-        logger.info('Push contains no new commits; no message generated.')
+    commit_count = push.get('commit_count', len(push['commits']))
+    if commit_count == 0:
+        log.info('no_commits',
+                 'Push contains no new commits; no message generated.')
         return None
 
     branch = m.group(1)
@@ -121,31 +326,62 @@ def message_from_push(push, slack_username=None, slack_channel=None):
     else:
         repo_link = repo_name
 
-    logger.info('Push received for {}, branch: {}'.format(repo_name,
-                                                          branch))
+    log.info('push', 'Push received for {repository}, branch: {branch}',
+             repository=repo_name, branch=branch)
 
-    commit_count = len(push['commits'])
     commits_text = ('one new commit' if commit_count == 1 else
                     '{} new commits'.format(commit_count))
 
     fallback = '[{}:{}] {}'.format(repo_name, branch, commits_text)
-    pretext = slack.Markup('[{}:{}] {}:').format(
-        repo_link, branch_link, commits_text)
+    pretext = _PRETEXT.format(repo_link, branch_link, commits_text)
+    new_commits = push['commits']
+    if seen_commits:
+        new_commits = [c for c in new_commits
+                       if c['id'] not in seen_commits]
+    seen_count = push.get('seen_count',
+                          len(push['commits']) - len(new_commits))
+    new_count = commit_count - seen_count
+
     commits = []
-    for commit in push.get('commits', []):
+    text_size = 0
+    for commit in islice(new_commits, max_commits):
         abbrev = commit['id'][:7]
         if 'url' in commit:
             commit_link = slack.Link(commit['url'], abbrev)
         else:
             commit_link = abbrev
-        commits.append(slack.Markup('{}: {} - {}').format(
-            commit_link, commit['message'], commit['author']['name']))
+        summary = commit['message'].partition('\n')[0][:max_text_size]
+        line = _COMMIT_LINE.format(
+            commit_link, summary, commit['author']['name'])
+
+        line_size = len(line.encode()) + 1
+        if commits and text_size + line_size > max_text_size:
+            break
+        commits.append(line)
+        text_size += line_size
+
+    if len(commits) < new_count:
+        commits.append(_MORE_COMMITS.format(new_count - len(commits)))
+    if seen_count:
+        commits.append(_SEEN_COMMITS.format(
+            'one commit' if seen_count == 1 else
+            '{:,} commits'.format(seen_count)))
+
     attachment = slack.Attachment(fallback=fallback,
                                   pretext=pretext,
                                   color='#4183c4',
                                   text=slack.Markup('\n').join(commits))
+    # Keep only the commits that can be listed when merged with a later
+    # push; seen commits are only counted
+    if seen_count or len(push['commits']) > max_commits:
+        push = dict(push, commits=list(islice(new_commits, max_commits)),
+                    commit_count=commit_count, seen_count=seen_count)
+    origin = PushOrigin(push, slack_username, slack_channel,
+                        {'max_commits': max_commits,
+                         'max_text_size': max_text_size})
     message = slack.Message(attachments=[attachment],
                             username=slack_username,
-                            channel=slack_channel)
+                            channel=slack_channel,
+                            origin=origin)
 
     return message
@@ -0,0 +1,389 @@
+
+"""Compiled routing and filtering rules"""
+
+import re
+import string
+import logging
+
+from git_slack.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class RulesError(Exception):
+    """Error in rule set"""
+
+
+# Attributes that are understood in a rule
+RULE_ATTRIBUTES = frozenset([
+    'filter', 'repository', 'branch', 'username', 'channel',
+    'repository_url', 'branch_url', 'commit_url', 'digest'])
+
+# Units of digest windows
+_WINDOW_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_WINDOW = re.compile(r'\s*(\d+(?:\.\d*)?)\s*([smhd]?)\s*\Z')
+
+
+def parse_window(value):
+    """Return seconds of digest window or None if digests are disabled
+
+    The window is a number of seconds or a string such as '90s', '5m',
+    '1h' or '1d'. False or 0 disables digests.
+    """
+    if value is None or value is False:
+        return None
+    if isinstance(value, bool):
+        raise ValueError('invalid window {!r}'.format(value))
+    if isinstance(value, (int, float)):
+        seconds = value
+    else:
+        m = _WINDOW.match(str(value))
+        if not m:
+            raise ValueError('invalid window {!r}'.format(value))
+        seconds = float(m.group(1)) * _WINDOW_UNITS[m.group(2) or 's']
+    if seconds < 0:
+        raise ValueError('invalid window {!r}'.format(value))
+    return seconds or None
+
+
+class UrlTemplate(object):
+    """URL template that is parsed once and substituted on demand
+
+    Templates use Python format syntax with named fields. Templates
+    consisting only of plain fields are substituted by concatenation;
+    anything more elaborate (conversions, format specs, attribute
+    access) falls back to str.format.
+    """
+    def __init__(self, template, fields):
+        self._template = template
+        self._parts = []
+        self._simple = True
+
+        try:
+            parsed = list(string.Formatter().parse(template))
+        except ValueError as e:
+            raise RulesError('Invalid URL template {!r}: {}'.format(
+                template, e))
+
+        for literal, field_name, format_spec, conversion in parsed:
+            if literal:
+                self._parts.append((True, literal))
+            if field_name is None:
+                continue
+
+            name = re.match(r'[^.[]*', field_name).group(0)
+            if name not in fields:
+                raise RulesError(
+                    'Invalid field {{{}}} in URL template {!r}; available'
+                    ' fields are: {}'.format(
+                        field_name, template, ', '.join(sorted(fields))))
+
+            if name != field_name or format_spec or conversion:
+                self._simple = False
+            self._parts.append((False, name))
+
+    @property
+    def template(self):
+        return self._template
+
+    def format(self, **kwargs):
+        if not self._simple:
+            return self._template.format(**kwargs)
+        return ''.join(value if is_literal else str(kwargs[value])
+                       for is_literal, value in self._parts)
+
+
+def anchored(pattern):
+    """Return pattern anchored at the end of the matched text
+
+    Like the original rule matching, only the end is anchored, so in an
+    alternation such as 'foo|bar' the anchor binds to the last branch.
+    """
+    return pattern + r'\Z'
+
+
+class Rule(object):
+    """Single compiled rule
+
+    The repository and branch patterns are compiled as anchored regular
+    expressions, the filter kind is validated and the URL templates are
+    parsed when the rule is created.
+    """
+    def __init__(self, rule_id, rule):
+        if not isinstance(rule, dict):
+            raise RulesError('Rule #{}: Rule must be a mapping'.format(
+                rule_id))
+
+        unknown = set(rule) - RULE_ATTRIBUTES
+        if unknown:
+            logger.warning('Rule #{}: Ignoring unknown attributes: {}'.format(
+                rule_id, ', '.join(sorted(str(k) for k in unknown))))
+
+        self.rule_id = rule_id
+
+        self.filter = rule.get('filter', None)
+        if 'filter' in rule and self.filter not in ('include', 'exclude'):
+            raise RulesError('Rule #{}: Filter attribute of rule must be'
+                             ' include or exclude'.format(rule_id))
+        self.include = self.filter == 'include'
+        self.exclude = self.filter == 'exclude'
+
+        self.repository_pattern = self._pattern(rule, 'repository')
+        self.repository = self._compile_pattern(rule, 'repository')
+        self.branch_pattern = self._pattern(rule, 'branch')
+        self.branch = self._compile_pattern(rule, 'branch')
+
+        self.username = rule.get('username', None)
+        self.channel = rule.get('channel', None)
+        self.has_username = 'username' in rule
+        self.has_channel = 'channel' in rule
+
+        self.has_digest = 'digest' in rule
+        try:
+            self.digest = parse_window(rule.get('digest'))
+        except ValueError as e:
+            raise RulesError('Rule #{}: Digest attribute: {}'.format(
+                rule_id, e))
+
+        self.repository_url = self._compile_template(
+            rule, 'repository_url', ('repository',))
+        self.branch_url = self._compile_template(
+            rule, 'branch_url', ('repository', 'branch'))
+        self.commit_url = self._compile_template(
+            rule, 'commit_url', ('repository', 'branch', 'commit'))
+
+    def _pattern(self, rule, key):
+        return str(rule[key]) if key in rule else None
+
+    def _compile_pattern(self, rule, key):
+        if key not in rule:
+            return None
+        pattern = str(rule[key])
+        try:
+            return re.compile(anchored(pattern))
+        except re.error as e:
+            raise RulesError('Rule #{}: Invalid {} pattern {!r}: {}'.format(
+                self.rule_id, key, pattern, e))
+
+    def _compile_template(self, rule, key, fields):
+        if key not in rule:
+            return None
+        try:
+            return UrlTemplate(str(rule[key]), fields)
+        except RulesError as e:
+            raise RulesError('Rule #{}: {}'.format(self.rule_id, e))
+
+
+_PATTERN_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+
+
+def _is_literal(pattern):
+    """Return True if pattern only matches its own text"""
+    return not any(c in _PATTERN_SPECIAL for c in pattern)
+
+
+class _PatternIndex(object):
+    """Index of the repository or branch patterns of a rule set
+
+    Literal patterns are looked up in a dict. The remaining regular
+    expressions are combined into a single pattern of optional
+    lookaheads, one per rule, so that all matching rules are found in
+    one pass of the regex engine.
+    """
+    def __init__(self):
+        self._literals = {}
+        self._patterns = []
+        self._separate = []
+        self._combined = None
+
+    def add(self, rule_id, pattern, compiled):
+        if _is_literal(pattern):
+            self._literals.setdefault(pattern, []).append(rule_id)
+        else:
+            self._patterns.append((rule_id, pattern, compiled))
+
+    def build(self):
+        combinable = []
+        for rule_id, pattern, compiled in self._patterns:
+            # Back references depend on group numbering which changes
+            # when the pattern is embedded in the combined pattern.
+            if re.search(r'\\\d|\(\?P=', pattern):
+                self._separate.append((rule_id, compiled))
+            else:
+                combinable.append((rule_id, pattern, compiled))
+
+        if combinable:
+            try:
+                self._combined = re.compile(''.join(
+                    r'(?:(?={})(?P<_rule{}>))?'.format(
+                        anchored(pattern), rule_id)
+                    for rule_id, pattern, _ in combinable))
+            except re.error:
+                # Patterns with e.g. inline global flags can not be
+                # combined; match them one at a time instead.
+                self._separate.extend((rule_id, compiled) for
+                                      rule_id, _, compiled in combinable)
+                self._combined = None
+
+    def matching(self, value):
+        """Return set of rule IDs with a pattern matching value"""
+        result = set(self._literals.get(value, ()))
+        if self._combined is not None:
+            m = self._combined.match(value)
+            result.update(int(name[5:]) for name, group in
+                          m.groupdict().items()
+                          if group is not None and name.startswith('_rule'))
+        for rule_id, compiled in self._separate:
+            if compiled.match(value):
+                result.add(rule_id)
+        return result
+
+
+class Outcome(object):
+    """Resolved result of a rule set for a repository and branch
+
+    Holds whether the push is filtered, and otherwise the resulting
+    Slack username and channel, the digest window in seconds (None if
+    pushes are posted one by one) and the URL settings. A URL attribute is
+    None if no rule changed it and the empty string if it should be
+    removed. Outcomes are shared between pushes and must not be
+    modified.
+    """
+    def __init__(self, repository, branch, filtered_by=None,
+                 filter_reason=None, rules=(), username=None,
+                 channel=None):
+        self.repository = repository
+        self.branch = branch
+        self.filtered_by = filtered_by
+        self.filter_reason = filter_reason
+        self.rules = tuple(rules)
+        self.username = username
+        self.channel = channel
+        self.digest = None
+        self.repository_url = None
+        self.branch_url = None
+        self.commit_url = None
+
+        for rule in self.rules:
+            if rule.has_username:
+                self.username = rule.username
+            if rule.has_channel:
+                self.channel = rule.channel
+            if rule.has_digest:
+                self.digest = rule.digest
+            if rule.repository_url is not None:
+                self.repository_url = rule.repository_url.format(
+                    repository=repository)
+            if rule.branch_url is not None:
+                self.branch_url = rule.branch_url.format(
+                    repository=repository, branch=branch)
+            if rule.commit_url is not None:
+                self.commit_url = rule.commit_url
+
+    @property
+    def filtered(self):
+        return self.filtered_by is not None
+
+    def format_commit_url(self, commit_id):
+        """Return URL of commit or None if no rule sets commit URLs"""
+        if self.commit_url is None:
+            return None
+        return self.commit_url.format(
+            repository=self.repository, branch=self.branch, commit=commit_id)
+
+
+class RuleSet(object):
+    """Compiled rule program
+
+    Built once from the list of rules in the configuration. Errors in
+    the rules are reported by raising RulesError when the rule set is
+    created.
+
+    Rules are indexed by their repository and branch patterns so that
+    evaluation only visits the rules that could affect a push: include
+    filters and unconditional rules are always visited while other
+    rules are only visited if one of their patterns match.
+
+    Outcomes are memoized in an LRU cache keyed by repository and branch
+    (and default Slack settings) of size cache_size.
+    """
+    def __init__(self, rules=None, cache_size=1024):
+        if rules is None:
+            rules = []
+        if not isinstance(rules, list):
+            raise RulesError('Rules must be a list')
+        self._rules = [Rule(rule_id, rule) for rule_id, rule in
+                       enumerate(rules)]
+
+        self._always = set()
+        self._repository_index = _PatternIndex()
+        self._branch_index = _PatternIndex()
+        for rule in self._rules:
+            if rule.include or (rule.repository is None and
+                                rule.branch is None):
+                self._always.add(rule.rule_id)
+            if rule.repository is not None:
+                self._repository_index.add(
+                    rule.rule_id, rule.repository_pattern, rule.repository)
+            if rule.branch is not None:
+                self._branch_index.add(
+                    rule.rule_id, rule.branch_pattern, rule.branch)
+        self._repository_index.build()
+        self._branch_index.build()
+
+        self._cache = LRUCache(cache_size)
+
+    def __iter__(self):
+        return iter(self._rules)
+
+    def __len__(self):
+        return len(self._rules)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def evaluate(self, repository, branch, username=None, channel=None):
+        """Evaluate rules for repository and branch and return Outcome
+
+        The first include filter that does not match, or exclude filter
+        that matches, filters the push. Otherwise, the rules that fully
+        match are applied in order on top of the default username and
+        channel.
+        """
+        key = (repository, branch, username, channel)
+        outcome = self._cache.get(key)
+        if outcome is None:
+            outcome = self._evaluate(repository, branch, username, channel)
+            self._cache.put(key, outcome)
+        return outcome
+
+    def _evaluate(self, repository, branch, username, channel):
+        repository_ids = self._repository_index.matching(repository)
+        branch_ids = self._branch_index.matching(branch)
+
+        matched = []
+        for rule_id in sorted(self._always | repository_ids | branch_ids):
+            rule = self._rules[rule_id]
+            all_match = True
+
+            if rule.repository is not None:
+                match = rule_id in repository_ids
+                all_match = match and all_match
+                if match and rule.exclude or not match and rule.include:
+                    return Outcome(repository, branch, rule_id, 'repository')
+
+            if rule.branch is not None:
+                match = rule_id in branch_ids
+                all_match = match and all_match
+                if match and rule.exclude or not match and rule.include:
+                    return Outcome(repository, branch, rule_id, 'branch')
+
+            if all_match:
+                matched.append(rule)
+
+        return Outcome(repository, branch, rules=matched,
+                       username=username, channel=channel)
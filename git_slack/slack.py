@@ -1,17 +1,47 @@
 
 """Slack integration functions"""
 
-import time
-from urllib.error import HTTPError
-from urllib import request
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException
+from email.utils import parsedate_to_datetime
 import json
-from threading import Thread
-from queue import Queue
+import math
+import time
+from threading import Thread, Semaphore, Lock, Event
+import random
+from queue import Queue, Empty
+from collections import deque
 import logging
 import string
-from collections import Mapping
+from functools import lru_cache
+from collections.abc import Mapping
+
+from git_slack.ratelimit import RateLimiter
+from git_slack.connection import ConnectionPool
+from git_slack.metrics import Counter, Histogram
+from git_slack.log import EventLog
 
 logger = logging.getLogger(__name__)
+log = EventLog(logger)
+
+
+POSTS = Counter('git_slack_posts', 'Posts to the WebHook by HTTP status',
+                ['status'])
+POST_SECONDS = Histogram('git_slack_post_seconds',
+                         'Duration of posts to the WebHook')
+DELIVERY_SECONDS = Histogram(
+    'git_slack_delivery_seconds',
+    'Time from enqueueing a message until it was posted')
+RETRIES = Counter('git_slack_retries', 'Failed posts that are retried')
+RATE_LIMITED = Counter('git_slack_rate_limited',
+                       'Posts rejected with a 429 response')
+RETRY_AFTER_SECONDS = Histogram(
+    'git_slack_retry_after_seconds', 'Retry-After delays of 429 responses',
+    buckets=(1, 2, 5, 10, 30, 60, 120, 300, 600))
+SUPERSEDED = Counter('git_slack_superseded_messages',
+                     'Queued messages replaced by a later message')
+DEAD_LETTERS = Counter('git_slack_dead_letters',
+                       'Messages given up on after failed posts')
 
 
 class AttachmentColor(object):
@@ -21,6 +51,11 @@ class AttachmentColor(object):
     Danger = 'danger'
 
 
+def _escape_text(s):
+    """Escape special characters in plain string"""
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
 class Markup(str):
     """Markup-safe string that does not need escaping"""
     @classmethod
@@ -30,12 +65,12 @@ class Markup(str):
         If already escape, or is an object that provides a custom
         markup, the result of the __markup__ method is returned.
         """
-        if hasattr(s, '__markup__'):
+        if type(s) is str:
+            return Markup(_escape_text(s))
+        elif hasattr(s, '__markup__'):
             return s.__markup__()
         else:
-            return Markup(s.replace('&', '&amp;').
-                          replace('<', '&lt;').
-                          replace('>', '&gt;'))
+            return Markup(_escape_text(s))
 
     def __markup__(self):
         return self
@@ -64,9 +99,7 @@ class Markup(str):
             Markup.escape(x) for x in iterable))
 
     def format(self, *args, **kwargs):
-        formatter = _MarkupEscapeFormatter(Markup.escape)
-        kwargs = _MagicFormatMapping(args, kwargs)
-        return Markup(formatter.vformat(self, args, kwargs))
+        return _cached_template(str(self)).format(*args, **kwargs)
 
     def __repr__(self):
         return (self.__class__.__name__ +
@@ -116,6 +149,89 @@ class _MarkupEscapeFormatter(string.Formatter):
         return str(self._escape(s))
 
 
+_LITERAL, _POSITIONAL, _KEYWORD = range(3)
+
+
+def _escape_field(value):
+    """Return escaped text of replacement field value"""
+    if type(value) is str:
+        return _escape_text(value)
+    elif hasattr(value, '__markup__'):
+        return str(Markup.escape(value.__markup__()))
+    else:
+        return _escape_text(format(value, ''))
+
+
+class MarkupTemplate(object):
+    """Markup format string that is parsed once
+
+    format() returns the same result as Markup.format on the template.
+    Templates with only plain replacement fields are substituted
+    directly; templates that use conversions, format specifications or
+    attribute and index lookups are formatted by Markup.format's
+    formatter.
+    """
+    def __init__(self, template):
+        self._template = Markup(template)
+        self._parts = self._parse(template)
+
+    @staticmethod
+    def _parse(template):
+        """Return list of parts or None if template is not simple"""
+        try:
+            parsed = list(string.Formatter().parse(template))
+        except ValueError:
+            return None
+
+        parts = []
+        auto_index = 0
+        numbering = None
+        for literal, field_name, format_spec, conversion in parsed:
+            if literal:
+                parts.append((_LITERAL, literal))
+            if field_name is None:
+                continue
+            if format_spec or conversion:
+                return None
+            if field_name == '':
+                if numbering == 'manual':
+                    return None
+                numbering = 'auto'
+                parts.append((_POSITIONAL, auto_index))
+                auto_index += 1
+            elif field_name.isdigit():
+                if numbering == 'auto':
+                    return None
+                numbering = 'manual'
+                parts.append((_POSITIONAL, int(field_name)))
+            elif field_name.isidentifier():
+                parts.append((_KEYWORD, field_name))
+            else:
+                return None
+        return parts
+
+    def format(self, *args, **kwargs):
+        if self._parts is None:
+            formatter = _MarkupEscapeFormatter(Markup.escape)
+            mapping = _MagicFormatMapping(args, kwargs)
+            return Markup(formatter.vformat(self._template, args, mapping))
+
+        result = []
+        for kind, value in self._parts:
+            if kind == _LITERAL:
+                result.append(value)
+            elif kind == _POSITIONAL:
+                result.append(_escape_field(args[value]))
+            else:
+                result.append(_escape_field(kwargs[value]))
+        return Markup(''.join(result))
+
+
+@lru_cache(maxsize=256)
+def _cached_template(template):
+    return MarkupTemplate(template)
+
+
 class _MarkupEscapeHelper(object):
     """Helper for Markup.__mod__"""
 
@@ -130,28 +246,63 @@ class _MarkupEscapeHelper(object):
     __float__ = lambda s: float(s._obj)
 
 
-class Link(object):
+class _Frozen(object):
+    """Base of immutable slotted objects
+
+    Attributes are set once with _set() from __init__.
+    """
+    __slots__ = ()
+
+    def _set(self, **attrs):
+        for name, value in attrs.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(
+            self.__class__.__name__))
+
+    __delattr__ = __setattr__
+
+
+_LINK = MarkupTemplate('<{}>')
+_TITLED_LINK = MarkupTemplate('<{}|{}>')
+
+
+class Link(_Frozen):
     """URL link in Slack text"""
+    __slots__ = ('_url', '_title')
+
     def __init__(self, url, title=None):
-        self._url = url
-        self._title = title
+        self._set(_url=url, _title=title)
 
     def __markup__(self):
         if self._title is None:
-            return Markup('<{}>').format(self._url)
-        return Markup('<{}|{}>').format(self._url, self._title)
+            return _LINK.format(self._url)
+        return _TITLED_LINK.format(self._url, self._title)
+
+
+class Message(_Frozen):
+    """Slack WebHook message
 
+    Messages are immutable. The document and its JSON encoding are built
+    on first use and reused; the returned document must not be modified.
+    The origin, e.g. the push a message was rendered from, is not part
+    of the document and is not kept by merge().
+    """
+    __slots__ = ('text', 'username', 'channel', 'attachments', 'origin',
+                 '_document', '_payload')
 
-class Message(object):
-    """Slack WebHook message"""
     def __init__(self, text=None, username=None,
-                 channel=None, attachments=None):
-        self.text = text
-        self.username = username
-        self.channel = channel
-        self.attachments = attachments
+                 channel=None, attachments=None, origin=None):
+        if attachments is not None:
+            attachments = tuple(attachments)
+        self._set(text=text, username=username, channel=channel,
+                  attachments=attachments, origin=origin, _document=None,
+                  _payload=None)
 
     def document(self):
+        if self._document is not None:
+            return self._document
         doc = {}
         if self.text is not None:
             doc['text'] = Markup.escape(self.text)
@@ -162,24 +313,82 @@ class Message(object):
         if self.attachments is not None:
             doc['attachments'] = [a.document() for a in
                                   self.attachments]
+        self._set(_document=doc)
         return doc
 
+    def payload(self):
+        """Return document encoded as JSON bytes"""
+        if self._payload is None:
+            self._set(_payload=json.dumps(self.document()).encode())
+        return self._payload
+
+    @classmethod
+    def from_document(cls, doc, origin=None):
+        """Return message from WebHook document as returned by document()"""
+        attachments = doc.get('attachments')
+        if attachments is not None:
+            attachments = [Attachment.from_document(a) for a in attachments]
+        text = doc.get('text')
+        return cls(text=Markup(text) if text is not None else None,
+                   username=doc.get('username'),
+                   channel=doc.get('channel'),
+                   attachments=attachments, origin=origin)
+
+    def merge(self, other):
+        """Return new message with text and attachments of both messages
+
+        Username and channel are taken from this message.
+        """
+        if self.text is None:
+            text = other.text
+        elif other.text is None:
+            text = self.text
+        else:
+            text = Markup('\n').join([self.text, other.text])
+
+        if self.attachments is None and other.attachments is None:
+            attachments = None
+        else:
+            attachments = ((self.attachments or ()) +
+                           (other.attachments or ()))
+
+        return Message(text=text, username=self.username,
+                       channel=self.channel, attachments=attachments)
+
+
+class Attachment(_Frozen):
+    """Slack message attachment
+
+    Attachments are immutable and their document is built on first use.
+    """
+    __slots__ = ('fallback', 'color', 'pretext', 'author', 'title',
+                 'title_link', 'text', 'image_url', '_document')
 
-class Attachment(object):
-    """Slack message attachment"""
     def __init__(self, fallback, color=None, pretext=None,
                  author=None, title=None, title_link=None,
                  text=None, image_url=None):
-        self.fallback = fallback
-        self.color = color
-        self.pretext = pretext
-        self.author = author
-        self.title = title
-        self.title_link = title_link
-        self.text = text
-        self.image_url = image_url
+        self._set(fallback=fallback, color=color, pretext=pretext,
+                  author=author, title=title, title_link=title_link,
+                  text=text, image_url=image_url, _document=None)
+
+    @classmethod
+    def from_document(cls, doc):
+        """Return attachment from document as returned by document()"""
+        def markup(key):
+            return Markup(doc[key]) if key in doc else None
+
+        author = None
+        if 'author_name' in doc:
+            author = Author(doc['author_name'], doc.get('author_link'),
+                            doc.get('author_icon'))
+        return cls(doc['fallback'], color=doc.get('color'),
+                   pretext=markup('pretext'), author=author,
+                   title=markup('title'), title_link=doc.get('title_link'),
+                   text=markup('text'), image_url=doc.get('image_url'))
 
     def document(self):
+        if self._document is not None:
+            return self._document
         doc = {'fallback': self.fallback}
         if self.color is not None:
             doc['color'] = self.color
@@ -199,58 +408,586 @@ class Attachment(object):
             doc['text'] = Markup.escape(self.text)
         if self.image_url is not None:
             doc['image_url'] = self.image_url
+        self._set(_document=doc)
         return doc
 
 
-class Author(object):
+class Author(_Frozen):
     """Slack message attachment author"""
-    def __init__(self, name, link=None, icon=None):
-        self.name = name
-        self.link = link
-        self.icon = icon
+    __slots__ = ('name', 'link', 'icon')
 
+    def __init__(self, name, link=None, icon=None):
+        self._set(name=name, link=link, icon=icon)
+
+
+class Delivery(object):
+    """Message waiting to be posted
+
+    Tracks the number of enqueued messages that were coalesced into the
+    message, their spool entries, and the callbacks to call when the
+    message has left the queue, i.e. when it has been posted or given
+    up on. Failed posts are counted in attempts and a message that is
+    waiting to be retried is not posted before retry_at (a time.monotonic
+    timestamp). The enqueued timestamp is the time the oldest of the
+    messages was enqueued. The traces of the pushes that the messages
+    came from are finished when the message leaves the queue.
+    """
+    def __init__(self, message, callbacks=(), count=1, spool_ids=(),
+                 attempts=0, retry_at=0.0, enqueued=None, traces=()):
+        self.message = message
+        self.callbacks = list(callbacks)
+        self.count = count
+        self.spool_ids = list(spool_ids)
+        self.attempts = attempts
+        self.retry_at = retry_at
+        self.enqueued = time.monotonic() if enqueued is None else enqueued
+        self.traces = list(traces)
+
+    @property
+    def channel(self):
+        return self.message.channel
+
+    @property
+    def username(self):
+        return self.message.username
+
+    def merge(self, other, message=None):
+        """Return delivery of both deliveries
+
+        The message is the merge of both messages unless given.
+        """
+        if message is None:
+            message = self.message.merge(other.message)
+        return Delivery(message,
+                        self.callbacks + other.callbacks,
+                        self.count + other.count,
+                        self.spool_ids + other.spool_ids,
+                        max(self.attempts, other.attempts),
+                        max(self.retry_at, other.retry_at),
+                        min(self.enqueued, other.enqueued),
+                        self.traces + other.traces)
+
+    def mark(self, event, detail=None):
+        """Mark event in traces of delivery"""
+        for trace in self.traces:
+            trace.mark(event, detail)
+
+    def done(self):
+        for callback in self.callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.warning('Delivery callback failed:', exc_info=True)
+        for trace in self.traces:
+            trace.finish()
+
+
+class MessageScheduler(object):
+    """Pending messages ordered for delivery to a WebHook endpoint
+
+    Messages waiting for the same channel and username are coalesced
+    into one message, up to max_attachments attachments and
+    max_message_size bytes of JSON.
+
+    Posting is rate limited by a token bucket per channel which refills
+    at rate messages per second (by default one per min_post_delay
+    seconds) up to burst messages, and by a token bucket for the
+    endpoint as a whole. A message is ready as soon as both its channel
+    and the endpoint have a token, so a busy channel does not hold back
+    messages to other channels. A RateLimiter can be passed to share
+    channel buckets between schedulers.
+
+    If supersede is given, an added message with an origin can take the
+    place of a pending message that has not been posted yet. supersede
+    is called with the pending and the added message and returns the
+    message replacing both, or None if the added message does not
+    supersede the pending one. If it raises, the added message is kept
+    unmerged.
+    """
+
+    def __init__(self, endpoint=None, min_post_delay=6.0,
+                 max_attachments=20, max_message_size=40000,
+                 rate=None, burst=1, endpoint_rate=1.0, endpoint_burst=1,
+                 limiter=None, supersede=None):
+        self._endpoint = endpoint
+        self._supersede = supersede
+        self._max_attachments = max_attachments
+        self._max_message_size = max_message_size
+        if limiter is None:
+            if rate is None:
+                rate = 1.0 / min_post_delay
+            limiter = RateLimiter(rate, burst)
+        self._limiter = limiter
+        self._endpoint_limiter = RateLimiter(endpoint_rate, endpoint_burst)
+        self._pending = deque()
 
-class SlackWebHook(Thread):
-    """Threaded interface to WebHooks API"""
-
-    def __init__(self, endpoint=None, min_post_delay=6.0):
-        super(SlackWebHook, self).__init__()
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, delivery):
+        if (self._supersede is not None and
+                delivery.message.origin is not None):
+            for index in range(len(self._pending) - 1, -1, -1):
+                pending = self._pending[index]
+                if pending.attempts or pending.message.origin is None:
+                    continue
+                try:
+                    message = self._supersede(pending.message,
+                                              delivery.message)
+                except Exception:
+                    logger.warning('Unable to merge message:',
+                                   exc_info=True)
+                    break
+                if message is not None:
+                    SUPERSEDED.inc()
+                    delivery.mark('superseded')
+                    self._pending[index] = pending.merge(delivery, message)
+                    return
+        self._pending.append(delivery)
+
+    def retry(self, delivery):
+        """Put delivery back in front of the pending list"""
+        self._pending.appendleft(delivery)
+
+    def _message_size(self, message):
+        return len(message.payload())
+
+    def bucket_key(self, delivery):
+        return self._endpoint, delivery.channel
+
+    def block(self, delivery, seconds):
+        """Block channel of delivery for a number of seconds"""
+        self._limiter.block(self.bucket_key(delivery), seconds)
+
+    def wait_time(self, busy=()):
+        """Return seconds until a pending message can be posted
+
+        Returns None if there are no pending messages for channels that
+        are not busy.
+        """
+        now = time.monotonic()
+        waits = [max(self._limiter.wait_time(self.bucket_key(d)),
+                     d.retry_at - now)
+                 for d in self._pending if self.bucket_key(d) not in busy]
+        if not waits:
+            return None
+        return max(self._endpoint_limiter.wait_time(self._endpoint),
+                   min(waits))
+
+    def next_delivery(self, busy=()):
+        """Remove next message to post from pending list
+
+        Returns the first pending delivery for a channel that is not rate
+        limited or in busy, or None if there is no such delivery. A
+        delivery waiting to be retried holds back later messages for its
+        channel. Later messages for the same channel and username are
+        merged into the returned delivery as long as the limits allow
+        it. Messages that are not merged keep their order in the pending
+        list.
+        """
+        if self._endpoint_limiter.wait_time(self._endpoint) > 0:
+            return None
+
+        now = time.monotonic()
+        blocked = set(busy)
+        for index, delivery in enumerate(self._pending):
+            key = self.bucket_key(delivery)
+            if key in blocked:
+                continue
+            if delivery.retry_at > now:
+                blocked.add(key)
+                continue
+            if self._limiter.consume(key):
+                break
+        else:
+            return None
+
+        self._endpoint_limiter.consume(self._endpoint)
+
+        key = delivery.channel, delivery.username
+        size = self._message_size(delivery.message)
+        count = len(delivery.message.attachments or [])
+
+        remaining = deque()
+        for other_index, other in enumerate(self._pending):
+            if other_index > index and (other.channel, other.username) == key:
+                other_size = self._message_size(other.message)
+                other_count = len(other.message.attachments or [])
+                if (count + other_count <= self._max_attachments and
+                        size + other_size <= self._max_message_size):
+                    delivery = delivery.merge(other)
+                    size += other_size
+                    count += other_count
+                    continue
+            if other_index != index:
+                remaining.append(other)
+
+        self._pending = remaining
+        return delivery
+
+
+def is_retryable(error):
+    """Return True if a failed post should be retried
+
+    Server errors, request timeouts, connection errors and timeouts are
+    transient; other client errors are not.
+    """
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 408
+    return isinstance(error, (URLError, OSError, HTTPException))
+
+
+def parse_retry_after(value, now=None):
+    """Return seconds to wait from a Retry-After header value
+
+    The value is a number of seconds or an HTTP date. Returns None if it
+    can not be parsed.
+    """
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+        if date is None or date.tzinfo is None:
+            return None
+        seconds = date.timestamp() - (time.time() if now is None else now)
+    if not math.isfinite(seconds):
+        return None
+    return max(0.0, seconds)
+
+
+class DeadLetterFile(object):
+    """Dead letter sink appending undeliverable messages to a file
+
+    Each line of the file is a JSON object with the time, the error and
+    the message document.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+
+    def __call__(self, message, error):
+        line = json.dumps({'time': time.time(), 'error': str(error),
+                           'message': message.document()})
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(line + '\n')
+
+
+class BaseWebHook(object):
+    """Queue bookkeeping shared by the WebHook delivery engines
+
+    At most max_queue_size messages are held; enqueue blocks while the
+    hook is full. Zero means no limit.
+
+    If a Spool is given, messages are written to it when enqueued and
+    marked as delivered when they leave the queue. Messages left in the
+    spool by a previous run are delivered first.
+
+    Posts that fail with a transient error are retried up to max_retries
+    times after a jittered exponential backoff starting at retry_delay
+    seconds and capped at max_retry_delay seconds. Messages that can not
+    be delivered are passed to dead_letter, a callable taking the message
+    and the error, e.g. a DeadLetterFile.
+    """
+
+    def __init__(self, max_queue_size=0, spool=None, max_retries=5,
+                 retry_delay=1.0, max_retry_delay=300.0, dead_letter=None):
+        self._capacity = (Semaphore(max_queue_size) if max_queue_size > 0
+                          else None)
+        self._spool = spool
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._dead_letter = dead_letter
+
+        self._restarts = 0
+        self._last_error = None
+        self._last_error_time = None
+        self._last_delivery_time = None
+        self._delivered = 0
+        self._retries = 0
+        self._rate_limited = 0
+        self._dead_letters = 0
+
+    def _new_delivery(self, message, callback=None, trace=None):
+        if self._capacity is not None:
+            self._capacity.acquire()
+        callbacks = [callback] if callback is not None else []
+        spool_ids = []
+        if self._spool is not None:
+            spool_ids.append(self._spool.append(message.document(),
+                                                message.payload()))
+        traces = []
+        if trace is not None:
+            trace.mark('enqueued')
+            traces.append(trace)
+        return Delivery(message, callbacks, spool_ids=spool_ids,
+                        traces=traces)
+
+    def _spooled_deliveries(self):
+        """Return deliveries for messages left in spool"""
+        if self._spool is None:
+            return []
+        deliveries = [Delivery(Message.from_document(document), count=0,
+                               spool_ids=[entry_id]) for
+                      entry_id, document in self._spool.pending()]
+        if deliveries:
+            logger.info('Replaying {} spooled messages'.format(
+                len(deliveries)))
+        return deliveries
+
+    def _done(self, delivery):
+        if self._spool is not None:
+            for entry_id in delivery.spool_ids:
+                self._spool.mark_delivered(entry_id)
+        if self._capacity is not None:
+            for _ in range(delivery.count):
+                self._capacity.release()
+        delivery.done()
+
+    def _log_post(self, delivery):
+        message = delivery.message
+        log.info('post', 'Posting message to {channel} ({size} bytes)',
+                 channel=message.channel, size=len(message.payload()),
+                 messages=delivery.count, attempt=delivery.attempts + 1)
+        log.debug('post_document', 'Posting message {document}',
+                  document=message.document)
+
+    def _send(self, delivery):
+        """Post message of delivery and record the post in metrics"""
+        delivery.mark('post')
+        started = time.monotonic()
+        try:
+            response = self._pool.post(self._endpoint,
+                                       delivery.message.payload())
+        except HTTPError as e:
+            POSTS.labels(e.code).inc()
+            raise
+        except Exception:
+            POSTS.labels('error').inc()
+            raise
+        else:
+            POSTS.labels(response.status).inc()
+        finally:
+            POST_SECONDS.observe(time.monotonic() - started)
+
+    def _posted(self, delivery):
+        delivery.mark('posted')
+        DELIVERY_SECONDS.observe(time.monotonic() - delivery.enqueued)
+        self._delivered += 1
+        self._last_delivery_time = time.time()
+        self._done(delivery)
+
+    def _record_error(self, error):
+        self._last_error = error
+        self._last_error_time = time.time()
+
+    def _failed(self, delivery, error):
+        """Retry delivery after failed post or give up on it"""
+        self._record_error(error)
+
+        if isinstance(error, HTTPError) and error.code == 429:
+            retry_after = parse_retry_after(
+                error.headers.get('Retry-After', '0'))
+            if retry_after is None:
+                retry_after = self._backoff(delivery.attempts)
+            log.info('rate_limited',
+                     'Channel {channel} rate limited for {seconds:g}'
+                     ' seconds', channel=delivery.channel,
+                     seconds=retry_after)
+            self._rate_limited += 1
+            RATE_LIMITED.inc()
+            RETRY_AFTER_SECONDS.observe(retry_after)
+            delivery.mark('rate_limited', retry_after)
+            self._scheduler.block(delivery, retry_after)
+            self._scheduler.retry(delivery)
+            return
+
+        if not is_retryable(error) or delivery.attempts >= self._max_retries:
+            log.warning('give_up',
+                        'Giving up on message after {attempts} attempts:'
+                        ' {error}', attempts=delivery.attempts + 1,
+                        error=error)
+            self._dead_letters += 1
+            DEAD_LETTERS.inc()
+            delivery.mark('dead_letter', str(error))
+            if self._dead_letter is not None:
+                try:
+                    self._dead_letter(delivery.message, error)
+                except Exception:
+                    logger.warning('Unable to store dead letter:',
+                                   exc_info=True)
+            self._done(delivery)
+            return
+
+        delay = self._backoff(delivery.attempts)
+        delivery.attempts += 1
+        delivery.retry_at = time.monotonic() + delay
+        log.info('retry',
+                 'Post failed ({error}); retrying in {delay:.1f} seconds',
+                 error=error, delay=delay)
+        self._retries += 1
+        RETRIES.inc()
+        delivery.mark('retry', round(delay, 3))
+        self._scheduler.retry(delivery)
+
+    def _backoff(self, attempts):
+        """Return jittered exponential delay before retrying"""
+        delay = min(self._max_retry_delay, self._retry_delay * 2 ** attempts)
+        return random.uniform(delay / 2, delay)
+
+    def _restart_delay(self):
+        return min(60.0, 2 ** min(self._restarts, 6))
+
+    def _is_alive(self):
+        raise NotImplementedError
+
+    def _queued(self):
+        return len(self._scheduler)
+
+    def health(self):
+        """Return dict describing state of the delivery worker"""
+        return {
+            'alive': self._is_alive(),
+            'queued': self._queued(),
+            'restarts': self._restarts,
+            'delivered': self._delivered,
+            'retries': self._retries,
+            'rate_limited': self._rate_limited,
+            'dead_letters': self._dead_letters,
+            'last_error': (str(self._last_error)
+                           if self._last_error is not None else None),
+            'last_error_time': self._last_error_time,
+            'last_delivery_time': self._last_delivery_time,
+        }
+
+
+class SlackWebHook(BaseWebHook, Thread):
+    """Threaded interface to WebHooks API
+
+    Messages are ordered, coalesced and rate limited by a
+    MessageScheduler created from the keyword arguments. Retry-After
+    responses only block the channel that was posted to.
+
+    The thread supervises the delivery loop: if the loop fails, the
+    error is recorded in health() and the loop is restarted after a
+    delay.
+
+    Messages are posted over persistent connections from pool, a
+    ConnectionPool. See BaseWebHook for the queue, spool and retry
+    options.
+    """
+
+    def __init__(self, endpoint=None, pool=None, max_queue_size=0,
+                 spool=None, max_retries=5, retry_delay=1.0,
+                 max_retry_delay=300.0, dead_letter=None, **kwargs):
+        BaseWebHook.__init__(self, max_queue_size, spool, max_retries,
+                             retry_delay, max_retry_delay, dead_letter)
+        Thread.__init__(self)
         self._endpoint = endpoint
-        self._min_post_delay = min_post_delay
+        self._pool = ConnectionPool() if pool is None else pool
+        self._scheduler = MessageScheduler(endpoint, **kwargs)
         self._message_queue = Queue()
+        for delivery in self._spooled_deliveries():
+            self._scheduler.add(delivery)
+        # Deliveries being added to the scheduler and posted, recovered
+        # when the delivery loop fails
+        self._taken = None
+        self._current = None
+        self._stopped = Event()
         self._running = True
 
-    def enqueue(self, message):
-        self._message_queue.put(message)
+    def enqueue(self, message, callback=None, trace=None):
+        """Add message to queue
+
+        The callback is called from the delivery thread when the message
+        has been posted or given up on. If a Trace is given, the
+        progress of the message is marked in it.
+        """
+        self._message_queue.put(self._new_delivery(message, callback, trace))
 
     def stop(self):
         self._running = False
+        self._stopped.set()
         self._message_queue.put(None)
 
-    def run(self):
+    def _is_alive(self):
+        return self.is_alive()
+
+    def _queued(self):
+        return len(self._scheduler) + self._message_queue.qsize()
+
+    def _drain_queue(self):
+        """Move all queued messages to the scheduler"""
+        while True:
+            try:
+                delivery = self._message_queue.get_nowait()
+            except Empty:
+                break
+            if delivery is not None:
+                self._add(delivery)
+
+    def _add(self, delivery):
+        """Add delivery taken from the queue to the scheduler"""
+        self._taken = delivery
+        self._scheduler.add(delivery)
+        self._taken = None
+
+    def _deliver(self):
+        """Delivery loop"""
         while self._running:
-            message = self._message_queue.get()
-            if message is None:
+            if not self._scheduler:
+                delivery = self._message_queue.get()
+                if delivery is not None:
+                    self._add(delivery)
                 continue
 
-            logger.info('Posting message {}'.format(message.document()))
+            self._drain_queue()
+            delivery = self._scheduler.next_delivery()
+            if delivery is None:
+                # Wait until a channel is ready or a new message arrives
+                try:
+                    delivery = self._message_queue.get(
+                        timeout=self._scheduler.wait_time())
+                except Empty:
+                    pass
+                else:
+                    if delivery is not None:
+                        self._add(delivery)
+                continue
+
+            self._current = delivery
+            delivery.mark('dequeued')
+            self._log_post(delivery)
 
             # Post to endpoint
-            data = json.dumps(message.document())
-            req = request.Request(self._endpoint, data.encode(),
-                                  {'Content-Type': 'application/json'})
             try:
-                f = request.urlopen(req)
-                response = f.read()
-                f.close()
-                retry_after = 0
-            except HTTPError as e:
-                if e.code == 429:
-                    retry_after = int(e.headers.get('Retry-After', '0'))
-                else:
-                    raise
+                self._send(delivery)
+            except Exception as e:
+                self._failed(delivery, e)
+            else:
+                self._posted(delivery)
+            self._current = None
 
-            # Wait to avoid flooding
-            wait_time = max(retry_after, self._min_post_delay)
-            logger.info('Waiting for {} seconds'.format(wait_time))
-            time.sleep(wait_time)
+    def run(self):
+        while self._running:
+            try:
+                self._deliver()
+            except Exception as e:
+                self._restarts += 1
+                self._record_error(e)
+                logger.error('Delivery worker failed; restarting:',
+                             exc_info=True)
+                if self._taken is not None:
+                    # Keep it pending without merging it
+                    delivery, self._taken = self._taken, None
+                    self._scheduler.retry(delivery)
+                if self._current is not None:
+                    delivery, self._current = self._current, None
+                    self._failed(delivery, e)
+                self._stopped.wait(self._restart_delay())
+
+        self._pool.close()
@@ -0,0 +1,363 @@
+
+"""End-to-end soak test of the daemon
+
+Run with ``python -m git_slack.soak``. The daemon is run against kombu's
+in-memory AMQP transport and a local HTTP server imitating the Slack
+WebHook, which can be made slow, rate limiting or failing. Pushes are
+published at a target rate and the end-to-end latency of each push,
+from publishing to the stub receiving it, is measured along with
+throughput, the number of pushes in flight over time and the memory use
+of the process.
+"""
+
+import re
+import sys
+import copy
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+from threading import Thread, Event, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from kombu import Connection, Exchange, Producer
+
+from git_slack import daemon
+from git_slack.benchmark import make_push
+
+logger = logging.getLogger(__name__)
+
+
+# Pushes are identified by the summary line of their first commit
+_PUSH_ID = re.compile(r'soak push (\d+)\b')
+
+
+class _SlackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, headers = self.server.stub.respond(body)
+        data = b'ok' if status == 200 else b'error'
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlackStub(object):
+    """Local HTTP server imitating a Slack WebHook
+
+    Each post is answered after latency seconds. A fraction rate_limit
+    of posts is answered with 429 and a Retry-After header of
+    retry_after seconds, and a fraction errors with 500. For accepted
+    posts, on_message is called with the posted document and the time
+    (time.monotonic) it was received.
+    """
+    def __init__(self, latency=0.0, rate_limit=0.0, retry_after=1,
+                 errors=0.0, on_message=None, seed=None,
+                 address=('127.0.0.1', 0)):
+        self._latency = latency
+        self._rate_limit = rate_limit
+        self._retry_after = retry_after
+        self._errors = errors
+        self._on_message = on_message
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer(address, _SlackHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+        self.requests = 0
+        self.accepted = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/services/soak'.format(host, port)
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever,
+                              args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def respond(self, body):
+        """Return status and headers of response to posted body"""
+        if self._latency > 0:
+            time.sleep(self._latency)
+        with self._lock:
+            self.requests += 1
+            draw = self._random.random()
+            if draw < self._rate_limit:
+                self.rate_limited += 1
+                return 429, [('Retry-After', str(self._retry_after))]
+            if draw < self._rate_limit + self._errors:
+                self.errors += 1
+                return 500, []
+            self.accepted += 1
+
+        if self._on_message is not None:
+            self._on_message(json.loads(body.decode()), time.monotonic())
+        return 200, []
+
+
+def memory_usage():
+    """Return resident memory of the process in bytes
+
+    Falls back to the peak resident memory where the current usage is
+    not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    """Return p-th percentile of sorted values (nearest rank)"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1,
+                       int(round(p / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+class Soak(object):
+    """Soak test run
+
+    The daemon is configured from config, except that it posts to the
+    stub and consumes from the in-memory transport. Unless config has
+    rules, pushes to the repositories are routed round robin to the
+    channels.
+    """
+    def __init__(self, rate=10.0, duration=30.0, repositories=10,
+                 channels=5, commits=1, config=None, sample_interval=1.0,
+                 drain_timeout=60.0, **stub_options):
+        self._rate = rate
+        self._duration = duration
+        self._repositories = repositories
+        self._commits = commits
+        self._sample_interval = sample_interval
+        self._drain_timeout = drain_timeout
+
+        self._lock = Lock()
+        self._published = {}
+        self._publishing = True
+        self._latencies = []
+        self._received = Event()
+        self._samples = []
+
+        self._stub = SlackStub(on_message=self._on_message, **stub_options)
+
+        self._config = copy.deepcopy(config or {})
+        self._config.setdefault('slack', {})['webhook_url'] = self._stub.url
+        amqp = self._config.setdefault('amqp', {})
+        amqp['url'] = 'memory://'
+        amqp.setdefault('transport_options', {'polling_interval': 0.01})
+        if 'rules' not in self._config:
+            self._config['rules'] = [
+                {'repository': 'soak/repo-{}'.format(i),
+                 'channel': '#soak-{}'.format(i % channels)}
+                for i in range(repositories)]
+
+    def _on_message(self, document, received):
+        texts = [a.get('text', '') for a in document.get('attachments', [])]
+        with self._lock:
+            for push_id in _PUSH_ID.findall('\n'.join(texts)):
+                published = self._published.pop(int(push_id), None)
+                if published is not None:
+                    self._latencies.append(received - published)
+            if not self._publishing and not self._published:
+                self._received.set()
+
+    def _push(self, push_id):
+        push = make_push(self._commits,
+                         'soak/repo-{}'.format(
+                             push_id % self._repositories),
+                         seed=push_id)
+        push['commits'][0]['message'] = 'soak push {}'.format(push_id)
+        return push
+
+    def _sample(self, start, stop):
+        while not stop.wait(self._sample_interval):
+            with self._lock:
+                in_flight = len(self._published)
+            self._samples.append({
+                'time': time.monotonic() - start,
+                'in_flight': in_flight,
+                'memory': memory_usage()})
+
+    def run(self, warmup=1.0):
+        """Run soak test and return report"""
+        self._stub.start()
+        stop_daemon = Event()
+        daemon_thread = Thread(target=daemon.run,
+                               args=(self._config, stop_daemon))
+        daemon_thread.start()
+
+        stop_sampler = Event()
+        try:
+            # Let the daemon declare and bind its queue
+            time.sleep(warmup)
+            memory_start = memory_usage()
+            start = time.monotonic()
+            sampler = Thread(target=self._sample,
+                             args=(start, stop_sampler))
+            sampler.start()
+
+            exchange = Exchange('git', type='topic', durable=False)
+            count = int(self._rate * self._duration)
+            with Connection('memory://') as connection:
+                producer = Producer(connection, exchange=exchange)
+                for push_id in range(count):
+                    delay = start + push_id / self._rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    push = self._push(push_id)
+                    with self._lock:
+                        self._published[push_id] = time.monotonic()
+                    producer.publish(push, routing_key='soak.push',
+                                     serializer='json')
+            published_time = time.monotonic() - start
+            with self._lock:
+                self._publishing = False
+                if not self._published:
+                    self._received.set()
+
+            self._received.wait(self._drain_timeout)
+            elapsed = time.monotonic() - start
+        finally:
+            stop_sampler.set()
+            stop_daemon.set()
+            daemon_thread.join()
+            self._stub.stop()
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+            lost = len(self._published)
+        memory_end = memory_usage()
+        return {
+            'published': count,
+            'delivered': len(latencies),
+            'lost': lost,
+            'publish_seconds': published_time,
+            'seconds': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None},
+            'memory': {
+                'start': memory_start,
+                'end': memory_end,
+                'growth': memory_end - memory_start},
+            'slack': {
+                'requests': self._stub.requests,
+                'accepted': self._stub.accepted,
+                'rate_limited': self._stub.rate_limited,
+                'errors': self._stub.errors},
+            'samples': self._samples,
+        }
+
+
+def _format_report(report):
+    def seconds(value):
+        return '-' if value is None else '{:.3f} s'.format(value)
+
+    lines = [
+        'Published:   {} pushes in {:.1f} s'.format(
+            report['published'], report['publish_seconds']),
+        'Delivered:   {} pushes in {:.1f} s ({:.1f}/s), {} lost'.format(
+            report['delivered'], report['seconds'], report['throughput'],
+            report['lost']),
+        'Latency:     p50 {}, p90 {}, p99 {}, max {}'.format(
+            *(seconds(report['latency'][k])
+              for k in ('p50', 'p90', 'p99', 'max'))),
+        'Slack:       {requests} posts, {accepted} accepted,'
+        ' {rate_limited} rate limited, {errors} errors'.format(
+            **report['slack']),
+        'Memory:      {:.1f} MiB -> {:.1f} MiB ({:+.1f} MiB)'.format(
+            *(report['memory'][k] / 2**20
+              for k in ('start', 'end', 'growth'))),
+        '',
+        '{:>8} {:>10} {:>12}'.format('time', 'in flight', 'memory'),
+    ]
+    for sample in report['samples']:
+        lines.append('{:>7.1f}s {:>10} {:>8.1f} MiB'.format(
+            sample['time'], sample['in_flight'], sample['memory'] / 2**20))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m git_slack.soak',
+        description='Soak test git-slack against a local Slack stub')
+    parser.add_argument('--config', metavar='file',
+                        help='Daemon configuration file')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='Pushes published per second')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='Seconds to publish pushes for')
+    parser.add_argument('--repositories', type=int, default=10,
+                        help='Number of repositories pushed to')
+    parser.add_argument('--channels', type=int, default=5,
+                        help='Number of channels posted to')
+    parser.add_argument('--commits', type=int, default=1,
+                        help='Number of commits per push')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the stub takes to respond')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='Fraction of posts answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After seconds of 429 responses')
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='Fraction of posts answered with 500')
+    parser.add_argument('--sample-interval', type=float, default=1.0,
+                        help='Seconds between samples of the queue')
+    parser.add_argument('--drain-timeout', type=float, default=60.0,
+                        help='Seconds to wait for pushes in flight')
+    parser.add_argument('--json', action='store_true',
+                        help='Write report as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show log messages of the daemon')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING)
+
+    config = daemon.load_config(args.config) if args.config else {}
+    report = Soak(rate=args.rate, duration=args.duration,
+                  repositories=args.repositories, channels=args.channels,
+                  commits=args.commits, config=config,
+                  sample_interval=args.sample_interval,
+                  drain_timeout=args.drain_timeout, latency=args.latency,
+                  rate_limit=args.rate_limit, retry_after=args.retry_after,
+                  errors=args.errors).run()
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(_format_report(report))
+    return 1 if report['lost'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+
+"""Durable on-disk spool of pending messages"""
+
+import os
+import re
+import json
+import mmap
+import struct
+import zlib
+import time
+import logging
+from threading import Thread, Lock, Condition
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolError(Exception):
+    """Error in spool"""
+
+
+# Record header: type, entry ID, payload length, CRC-32 of payload
+_HEADER = struct.Struct('<BQII')
+_APPEND = 1
+_DELIVERED = 2
+
+_SEGMENT_NAME = re.compile(r'^(\d{10})\.spool$')
+
+
+class _Segment(object):
+    """Segment file of the spool"""
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self.live = set()
+        self.size = 0
+
+
+class Spool(object):
+    """Append-only spool of JSON documents
+
+    Documents are appended to segment files in the spool directory and
+    marked as delivered by appending a delivery record. A new segment is
+    started when the active one grows past segment_size bytes. Segments
+    are deleted oldest first once all their documents are delivered;
+    when there are more than max_segments segments, the live documents
+    of the oldest segment are copied to the active segment so that it
+    can be deleted.
+
+    Writes are flushed and synced to disk by a background thread at most
+    sync_interval seconds after they are made, so that a burst of
+    appends shares a single fsync. Call sync() to wait for the records
+    written so far to be durable.
+
+    Documents that were not delivered when the spool was last closed are
+    returned by pending() when it is opened again.
+    """
+    def __init__(self, path, segment_size=16*1024*1024, max_segments=8,
+                 sync_interval=0.05):
+        self._path = path
+        self._segment_size = segment_size
+        self._max_segments = max(2, max_segments)
+        self._sync_interval = sync_interval
+
+        self._lock = Lock()
+        self._synced = Condition(self._lock)
+        self._written = 0
+        self._durable = 0
+        self._closed = False
+
+        self._segments = OrderedDict()
+        self._entries = OrderedDict()
+        self._next_id = 1
+        self._active = None
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+        number = (next(reversed(self._segments)) + 1 if self._segments
+                  else 1)
+        self._active = self._open_segment(number)
+
+        self._flusher = Thread(target=self._run_flusher)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _segment_path(self, number):
+        return os.path.join(self._path, '{:010d}.spool'.format(number))
+
+    def _open_segment(self, number):
+        segment = _Segment(self._segment_path(number), number)
+        segment.file = open(segment.path, 'ab')
+        segment.size = segment.file.tell()
+        self._segments[number] = segment
+        return segment
+
+    def _load(self):
+        numbers = sorted(int(m.group(1)) for m in
+                         (_SEGMENT_NAME.match(name) for name in
+                          os.listdir(self._path)) if m)
+        for number in numbers:
+            segment = _Segment(self._segment_path(number), number)
+            segment.file = None
+            self._segments[number] = segment
+            for kind, entry_id, payload in self._read_segment(segment):
+                self._next_id = max(self._next_id, entry_id + 1)
+                previous = self._entries.get(entry_id)
+                if previous is not None:
+                    # Delivered, or copied to a newer segment
+                    self._segments[previous[0]].live.discard(entry_id)
+                if kind == _APPEND:
+                    self._entries[entry_id] = (segment.number, payload)
+                    segment.live.add(entry_id)
+                elif previous is not None:
+                    del self._entries[entry_id]
+
+        # Compaction moves documents out of order; replay in append order
+        self._entries = OrderedDict(sorted(self._entries.items()))
+        self._delete_segments()
+
+    def _read_segment(self, segment):
+        """Yield records of segment file
+
+        Reading stops at the first incomplete or corrupt record, e.g.
+        one that was being written when the process stopped.
+        """
+        with open(segment.path, 'rb') as f:
+            segment.size = os.fstat(f.fileno()).st_size
+            if segment.size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                offset = 0
+                while offset + _HEADER.size <= len(m):
+                    kind, entry_id, length, crc = _HEADER.unpack_from(
+                        m, offset)
+                    start = offset + _HEADER.size
+                    payload = m[start:start+length]
+                    if (kind not in (_APPEND, _DELIVERED) or
+                            len(payload) != length or
+                            zlib.crc32(payload) != crc):
+                        logger.warning('Spool segment {} is truncated at'
+                                       ' offset {}'.format(segment.path,
+                                                           offset))
+                        return
+                    yield kind, entry_id, payload
+                    offset = start + length
+
+    def _write(self, kind, entry_id, payload=b''):
+        record = _HEADER.pack(kind, entry_id, len(payload),
+                              zlib.crc32(payload)) + payload
+        self._active.file.write(record)
+        self._active.size += len(record)
+        self._written += 1
+        self._synced.notify_all()
+
+    def _delete_segments(self):
+        """Delete oldest segments that have no live documents"""
+        while self._segments:
+            number, segment = next(iter(self._segments.items()))
+            if segment.live or segment is self._active:
+                break
+            del self._segments[number]
+            if segment.file is not None:
+                segment.file.close()
+            try:
+                os.remove(segment.path)
+            except OSError:
+                logger.warning('Unable to remove spool segment {}'.format(
+                    segment.path), exc_info=True)
+
+    def _compact(self):
+        """Copy live documents of oldest segment to active segment"""
+        number, segment = next(iter(self._segments.items()))
+        if segment is self._active:
+            return
+        for entry_id in sorted(segment.live):
+            _, payload = self._entries[entry_id]
+            self._write(_APPEND, entry_id, payload)
+            self._entries[entry_id] = (self._active.number, payload)
+            self._active.live.add(entry_id)
+        segment.live.clear()
+
+        # Copies must be durable before the segment is deleted
+        self._flush()
+        self._delete_segments()
+
+    def _roll(self):
+        if self._active.size < self._segment_size:
+            return
+        self._flush()
+        self._active.file.close()
+        self._active.file = None
+        self._active = self._open_segment(self._active.number + 1)
+        self._delete_segments()
+        if len(self._segments) > self._max_segments:
+            self._compact()
+
+    def append(self, document, payload=None):
+        """Append JSON document to spool and return its entry ID
+
+        If the document has already been encoded, its JSON bytes can be
+        passed as payload to avoid encoding it again.
+        """
+        if payload is None:
+            payload = json.dumps(document).encode()
+        with self._lock:
+            if self._closed:
+                raise SpoolError('Spool is closed')
+            entry_id = self._next_id
+            self._next_id += 1
+            self._write(_APPEND, entry_id, payload)
+            self._entries[entry_id] = (self._active.number, payload)
+            self._active.live.add(entry_id)
+            self._roll()
+        return entry_id
+
+    def mark_delivered(self, entry_id):
+        """Mark document as delivered so it will not be replayed"""
+        with self._lock:
+            if self._closed or entry_id not in self._entries:
+                return
+            number, _ = self._entries.pop(entry_id)
+            self._segments[number].live.discard(entry_id)
+            self._write(_DELIVERED, entry_id)
+            self._roll()
+            self._delete_segments()
+
+    def pending(self):
+        """Return list of entry ID and document of undelivered documents"""
+        with self._lock:
+            return [(entry_id, json.loads(payload.decode())) for
+                    entry_id, (_, payload) in self._entries.items()]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _flush(self):
+        """Flush and sync active segment; called with lock held"""
+        if self._written == self._durable:
+            return
+        self._active.file.flush()
+        os.fsync(self._active.file.fileno())
+        self._durable = self._written
+        self._synced.notify_all()
+
+    def sync(self):
+        """Wait until all records written so far are durable"""
+        with self._lock:
+            target = self._written
+            while self._durable < target and not self._closed:
+                self._synced.wait()
+
+    def _run_flusher(self):
+        with self._lock:
+            while not self._closed:
+                if self._durable == self._written:
+                    self._synced.wait()
+                    continue
+
+                # Let more writes accumulate before syncing them together
+                self._lock.release()
+                try:
+                    time.sleep(self._sync_interval)
+                finally:
+                    self._lock.acquire()
+                if not self._closed:
+                    self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._flush()
+            self._closed = True
+            self._synced.notify_all()
+            for segment in self._segments.values():
+                if segment.file is not None:
+                    segment.file.close()
+                    segment.file = None
+        self._flusher.join()
@@ -2,8 +2,26 @@
 """Unit tests"""
 
 import unittest
+import json
+import time
+import os
+import tempfile
+import shutil
+import threading
+import logging
+import queue
+import signal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.error import HTTPError
 
-from git_slack import slack, response
+from git_slack import slack, response, cache, ratelimit, connection, aio
+from git_slack import spool, benchmark, metrics, trace, log, digest
+
+try:
+    from git_slack import daemon, soak
+except ImportError:
+    # kombu is not installed
+    daemon = soak = None
 
 
 def populate_flags(push):
@@ -146,6 +164,50 @@ class TestPushResponse(unittest.TestCase):
             ' Test commit - Test Person')
         self.assertEqual(attachment['text'], text)
 
+    def test_only_first_line_of_commit_message(self):
+        push = self.minimal_push
+        push['commits'][0]['message'] = 'Test commit\n\nLong description'
+        message = response.message_from_push(push).document()
+        self.assertEqual(message['attachments'][0]['text'],
+                         slack.Markup('a697150: Test commit - Test Person'))
+
+    def test_large_push_is_summarized(self):
+        push = self.minimal_push
+        push['commits'] = push['commits'] * 20000
+        message = response.message_from_push(
+            push, max_commits=50).document()
+        attachment = message['attachments'][0]
+
+        self.assertEqual(attachment['fallback'],
+                         '[testing:master] 20000 new commits')
+        lines = attachment['text'].split('\n')
+        self.assertEqual(len(lines), 51)
+        self.assertEqual(lines[-1], '\u2026 and 19,950 more')
+
+    def test_commit_list_respects_size_limit(self):
+        push = self.minimal_push
+        push['commits'] = push['commits'] * 100
+        message = response.message_from_push(
+            push, max_text_size=400).document()
+        text = message['attachments'][0]['text']
+
+        self.assertLess(len(text.encode()), 450)
+        self.assertEqual(text.split('\n')[-1], '\u2026 and 89 more')
+
+    def test_seen_commits_are_counted(self):
+        push = self.minimal_push
+        merged = dict(push['commits'][0], id='b' * 40)
+        push['commits'] = [merged, merged, push['commits'][0]]
+        message = response.message_from_push(
+            push, seen_commits={'b' * 40}).document()
+        attachment = message['attachments'][0]
+
+        self.assertEqual(attachment['fallback'],
+                         '[testing:master] 3 new commits')
+        self.assertEqual(attachment['text'].split('\n'), [
+            'a697150: Test commit - Test Person',
+            '2 commits already announced'])
+
 
 class TestRules(unittest.TestCase):
     def test_push_exclude_rule_applying_to_repository(self):
@@ -390,3 +452,1614 @@ class TestRules(unittest.TestCase):
                          'a697150fd92f21ca186ac0f43cdef6000e6c3d2f')
              }]
         })
+
+    def test_applying_rules_does_not_modify_push(self):
+        push = {
+            'ref': 'refs/heads/master',
+            'deleted': False,
+            'url': 'http://old.example.com/',
+            'repository': {'full_name': 'testing'},
+            'commits': [
+                {'id': 'a697150fd92f21ca186ac0f43cdef6000e6c3d2f',
+                 'message': 'Test commit',
+                 'author': {'name': 'Test Person'}}
+            ]
+        }
+        rules = [{
+            'branch_url': '',
+            'commit_url': 'http://example.com/{repository}/commit/{commit}'
+        }]
+
+        new_push, _, _ = list(response.apply_rules(push, rules))[0]
+        self.assertNotIn('url', new_push)
+        self.assertEqual(push['url'], 'http://old.example.com/')
+        self.assertNotIn('url', push['commits'][0])
+
+        message = response.message_from_push(new_push).document()
+        text = slack.Markup(
+            '<http://example.com/testing/commit/'
+            'a697150fd92f21ca186ac0f43cdef6000e6c3d2f|a697150>:'
+            ' Test commit - Test Person')
+        self.assertEqual(message['attachments'][0]['text'], text)
+
+    def test_commits_of_push_view_are_read_only_sequence(self):
+        push = benchmark.make_push(60)
+        rules = [{'commit_url': 'http://example.com/{commit}'}]
+        new_push, _, _ = list(response.apply_rules(push, rules))[0]
+        commits = new_push['commits']
+        self.assertIs(commits[0], commits[0])
+        self.assertIs(commits[-1], commits[59])
+        self.assertEqual(len(list(commits) + list(commits)), 120)
+
+        message = response.message_from_push(new_push)
+        lines = message.attachments[0].text.split('\n')
+        self.assertEqual(len(lines), 51)
+        self.assertTrue(lines[0].startswith('<http://example.com/'))
+
+    def test_push_views_are_merged(self):
+        first, second = benchmark.make_push(2), benchmark.make_push(1, seed=1)
+        second['before'] = first['after']
+        rules = [{'commit_url': 'http://example.com/{commit}'}]
+        messages = [response.message_from_push(
+            list(response.apply_rules(push, rules))[0][0])
+            for push in (first, second)]
+
+        merged = response.supersede_message(*messages)
+        self.assertEqual(merged.attachments[0].fallback,
+                         '[org/repo-0:master] 3 new commits')
+        self.assertEqual(merged.origin.push['commits'][2]['url'],
+                         'http://example.com/' + second['commits'][0]['id'])
+
+
+class TestRuleSet(unittest.TestCase):
+    def test_invalid_filter_is_reported_on_compile(self):
+        with self.assertRaises(response.RulesError):
+            response.RuleSet([{'filter': 'maybe'}])
+
+    def test_invalid_pattern_is_reported_on_compile(self):
+        with self.assertRaises(response.RulesError):
+            response.RuleSet([{'repository': 'user/('}])
+
+    def test_invalid_template_field_is_reported_on_compile(self):
+        with self.assertRaises(response.RulesError):
+            response.RuleSet([{'repository_url': 'http://x/{branch}'}])
+
+    def test_compiled_rules_are_reusable(self):
+        rules = response.RuleSet([{
+            'repository': 'user/.*',
+            'channel': '#userrepos'
+        }])
+
+        for name, channel in (('user/a', '#userrepos'), ('testing', None),
+                              ('user/b', '#userrepos')):
+            push = {
+                'ref': 'refs/heads/master',
+                'repository': {'full_name': name}
+            }
+            result = list(response.apply_rules(push, rules))
+            self.assertEqual(result, [(push, None, channel)])
+
+    def test_template_with_format_spec(self):
+        rules = response.RuleSet([{
+            'commit_url': 'http://x/{repository}/{commit:.7}'
+        }])
+        push = {
+            'ref': 'refs/heads/master',
+            'repository': {'full_name': 'testing'},
+            'commits': [{'id': 'a697150fd92f21ca186ac0f43cdef6000e6c3d2f'}]
+        }
+        new_push, _, _ = list(response.apply_rules(push, rules))[0]
+        self.assertEqual(new_push['commits'][0]['url'],
+                         'http://x/testing/a697150')
+
+    def test_digest_window(self):
+        rules = response.RuleSet([
+            {'repository': 'mirror/.*', 'digest': '5m'},
+            {'repository': 'mirror/live', 'digest': False},
+        ])
+        self.assertEqual(rules.evaluate('mirror/a', 'master').digest, 300)
+        self.assertIsNone(rules.evaluate('mirror/live', 'master').digest)
+        self.assertIsNone(rules.evaluate('testing', 'master').digest)
+        self.assertEqual(
+            response.RuleSet([{'digest': 90}]).evaluate('a', 'b').digest, 90)
+
+    def test_invalid_digest_is_reported_on_compile(self):
+        with self.assertRaises(response.RulesError):
+            response.RuleSet([{'digest': 'soon'}])
+
+
+class TestRuleIndex(unittest.TestCase):
+    def setUp(self):
+        self.rules = response.RuleSet([
+            {'repository': 'gitolite-admin', 'filter': 'exclude'},
+            {'repository': 'user/.*', 'channel': '#userrepos'},
+            {'repository': 'user/(alice|bob)', 'username': 'friends'},
+            {'branch': 'wip-.*', 'repository': 'project', 'filter': 'exclude'},
+            {'repository': 'project', 'channel': '#project'},
+            {'repository_url': 'http://example.com/{repository}'},
+        ])
+
+    def matched(self, repository, branch):
+        outcome = self.rules.evaluate(repository, branch)
+        if outcome.filtered:
+            return outcome.filtered_by
+        return [rule.rule_id for rule in outcome.rules]
+
+    def test_literal_exclude(self):
+        self.assertEqual(self.matched('gitolite-admin', 'master'), 0)
+
+    def test_overlapping_regex_rules_in_order(self):
+        self.assertEqual(self.matched('user/alice', 'master'), [1, 2, 5])
+        self.assertEqual(self.matched('user/carol', 'master'), [1, 5])
+
+    def test_exclude_on_either_pattern(self):
+        self.assertEqual(self.matched('project', 'master'), 3)
+        self.assertEqual(self.matched('other', 'wip-1'), 3)
+        self.assertEqual(self.matched('other', 'master'), [5])
+
+    def test_back_reference_pattern(self):
+        rules = response.RuleSet([
+            {'repository': r'(\w+)/\1', 'channel': '#mirror'},
+            {'repository': 'x.*', 'channel': '#x'}])
+        outcome = rules.evaluate('abc/abc', 'master')
+        self.assertEqual([rule.rule_id for rule in outcome.rules], [0])
+        outcome = rules.evaluate('xyz/abc', 'master')
+        self.assertEqual([rule.rule_id for rule in outcome.rules], [1])
+
+    def test_uncombinable_patterns(self):
+        rules = response.RuleSet([
+            {'repository': '(?i)test.*', 'channel': '#a'},
+            {'repository': '(?i)other', 'channel': '#b'}])
+        outcome = rules.evaluate('TESTING', 'master')
+        self.assertEqual([rule.rule_id for rule in outcome.rules], [0])
+
+    def test_alternation_is_anchored_alike_in_both_paths(self):
+        alternation = {'repository': 'foo|bar', 'channel': '#a'}
+        combined = response.RuleSet([alternation])
+        separate = response.RuleSet([
+            alternation, {'repository': '(?i)other', 'channel': '#b'}])
+        for rules in (combined, separate):
+            for name, matched in (('foo', True), ('foobar', True),
+                                  ('bar', True), ('barx', False),
+                                  ('xbar', False)):
+                outcome = rules.evaluate(name, 'master')
+                self.assertEqual(
+                    [rule.rule_id for rule in outcome.rules],
+                    [0] if matched else [], name)
+
+    def test_outcome_is_cached(self):
+        first = self.rules.evaluate('user/alice', 'master')
+        second = self.rules.evaluate('user/alice', 'master')
+        self.assertIs(first, second)
+        self.assertEqual(self.rules.cache.hits, 1)
+        self.assertEqual(self.rules.cache.misses, 1)
+
+    def test_outcome_resolves_settings(self):
+        outcome = self.rules.evaluate('user/bob', 'master',
+                                      channel='#default')
+        self.assertEqual(outcome.username, 'friends')
+        self.assertEqual(outcome.channel, '#userrepos')
+        self.assertEqual(outcome.repository_url,
+                         'http://example.com/user/bob')
+        self.assertIsNone(outcome.branch_url)
+        self.assertIsNone(outcome.format_commit_url('a697150'))
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        c = cache.LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.put('c', 3)
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(c.info(), {'hits': 3, 'misses': 1,
+                                    'size': 2, 'maxsize': 2})
+
+    def test_clear(self):
+        c = cache.LRUCache(2)
+        c.put('a', 1)
+        c.clear()
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(len(c), 0)
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestDedupeCache(unittest.TestCase):
+    def test_keys_expire(self):
+        clock = FakeClock()
+        c = cache.DedupeCache(ttl=10, clock=clock)
+        self.assertTrue(c.add(('a',)))
+        self.assertFalse(c.add(('a',)))
+        self.assertIn(('a',), c)
+        clock.now += 10
+        self.assertNotIn(('a',), c)
+        self.assertTrue(c.add(('a',)))
+
+    def test_size_is_bounded(self):
+        c = cache.DedupeCache(maxsize=2)
+        for key in ('a', 'b', 'c'):
+            c.add((key,))
+        self.assertEqual(len(c), 2)
+        self.assertNotIn(('a',), c)
+        self.assertIn(('c',), c)
+
+    def test_confirmed_keys_are_persisted(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        path = os.path.join(path, 'dedupe.json')
+        clock = FakeClock()
+        c = cache.DedupeCache(ttl=10, path=path, clock=clock)
+        c.add(('a', 1))
+        c.add(('b', 2))
+        c.confirm(('a', 1))
+        c.save()
+
+        c = cache.DedupeCache(ttl=10, path=path, clock=clock)
+        self.assertIn(('a', 1), c)
+        self.assertNotIn(('b', 2), c)
+        clock.now += 10
+        c = cache.DedupeCache(ttl=10, path=path, clock=clock)
+        self.assertEqual(len(c), 0)
+
+    def test_discarded_keys_are_new(self):
+        c = cache.DedupeCache()
+        c.add(('a',))
+        c.discard(('a',))
+        c.discard(('b',))
+        self.assertNotIn(('a',), c)
+        self.assertTrue(c.add(('a',)))
+
+
+class TestRotatingBloomFilter(unittest.TestCase):
+    def test_added_keys_are_found(self):
+        f = cache.RotatingBloomFilter(1000, 0.01)
+        for i in range(1000):
+            f.add(str(i))
+        self.assertTrue(all(str(i) in f for i in range(1000)))
+        false_positives = sum(str(i) in f for i in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+        self.assertLess(f.nbytes, 2 * 1000 * 10 // 8 + 2)
+
+    def test_old_keys_are_forgotten(self):
+        f = cache.RotatingBloomFilter(10, 0.001)
+        f.add('old')
+        for i in range(20):
+            f.add(str(i))
+        self.assertIn('10', f)
+        self.assertNotIn('old', f)
+
+
+def attachment_message(text, channel=None, username=None):
+    return slack.Message(attachments=[slack.Attachment(text, text=text)],
+                         channel=channel, username=username)
+
+
+def delivery(text, channel=None, username=None):
+    return slack.Delivery(attachment_message(text, channel, username))
+
+
+class TestCoalescing(unittest.TestCase):
+    def test_messages_for_same_channel_are_merged(self):
+        scheduler = slack.MessageScheduler(endpoint_burst=2)
+        scheduler.add(delivery('a', channel='#a'))
+        scheduler.add(delivery('b', channel='#b'))
+        scheduler.add(delivery('c', channel='#a'))
+
+        message = scheduler.next_delivery().message.document()
+        self.assertEqual(message['channel'], '#a')
+        self.assertEqual([a['text'] for a in message['attachments']],
+                         ['a', 'c'])
+
+        message = scheduler.next_delivery().message.document()
+        self.assertEqual(message['channel'], '#b')
+        self.assertEqual(len(scheduler), 0)
+
+    def test_different_usernames_are_not_merged(self):
+        scheduler = slack.MessageScheduler()
+        scheduler.add(delivery('a', username='x'))
+        scheduler.add(delivery('b', username='y'))
+
+        self.assertEqual(len(scheduler.next_delivery().message.attachments), 1)
+        self.assertEqual(len(scheduler), 1)
+
+    def test_merging_respects_attachment_limit(self):
+        scheduler = slack.MessageScheduler(max_attachments=2, burst=2,
+                                           endpoint_burst=2)
+        for text in 'abc':
+            scheduler.add(delivery(text))
+
+        self.assertEqual(len(scheduler.next_delivery().message.attachments), 2)
+        self.assertEqual(len(scheduler.next_delivery().message.attachments), 1)
+
+
+def push_delivery(push, channel='#git'):
+    return slack.Delivery(response.message_from_push(
+        push, slack_channel=channel))
+
+
+class TestSupersede(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = slack.MessageScheduler(
+            supersede=response.supersede_message)
+        self.first = benchmark.make_push(2)
+        self.second = benchmark.make_push(1, seed=1)
+        self.second['before'] = self.first['after']
+
+    def test_continuing_push_extends_queued_message(self):
+        self.scheduler.add(push_delivery(self.first))
+        self.scheduler.add(push_delivery(self.second))
+        self.assertEqual(len(self.scheduler), 1)
+
+        merged = self.scheduler.next_delivery()
+        self.assertEqual(merged.count, 2)
+        attachment = merged.message.attachments[0]
+        self.assertEqual(len(merged.message.attachments), 1)
+        self.assertEqual(attachment.fallback,
+                         '[org/repo-0:master] 3 new commits')
+        self.assertEqual(merged.message.origin.push['before'],
+                         self.first['before'])
+        self.assertEqual(merged.message.origin.push['after'],
+                         self.second['after'])
+
+    def test_forced_push_replaces_queued_message(self):
+        self.second['forced'] = True
+        self.scheduler.add(push_delivery(self.first))
+        self.scheduler.add(push_delivery(self.second))
+
+        merged = self.scheduler.next_delivery()
+        self.assertEqual(merged.count, 2)
+        self.assertEqual(merged.message.attachments[0].fallback,
+                         '[org/repo-0:master] one new commit')
+
+    def test_failed_merge_keeps_message(self):
+        def supersede(message, other):
+            raise TypeError('merge failed')
+        scheduler = slack.MessageScheduler(supersede=supersede)
+        with self.assertLogs('git_slack.slack', 'WARNING'):
+            scheduler.add(push_delivery(self.first))
+            scheduler.add(push_delivery(self.second))
+        self.assertEqual(len(scheduler), 2)
+
+    def test_views_of_chained_pushes_are_merged(self):
+        rules = [{'commit_url': 'https://git.example.com/{commit}'}]
+        third = benchmark.make_push(1, seed=2)
+        third['before'] = self.second['after']
+        for push in (self.first, self.second, third):
+            (view, _, _), = response.apply_rules(push, rules)
+            self.scheduler.add(slack.Delivery(
+                response.message_from_push(view)))
+
+        merged = self.scheduler.next_delivery()
+        self.assertEqual(merged.count, 3)
+        self.assertEqual(merged.message.attachments[0].fallback,
+                         '[org/repo-0:master] 4 new commits')
+
+    def test_unrelated_pushes_are_kept(self):
+        other = benchmark.make_push(1, seed=2)
+        self.scheduler.add(push_delivery(self.first))
+        self.scheduler.add(push_delivery(self.second, channel='#other'))
+        self.scheduler.add(push_delivery(other))
+        self.assertEqual(len(self.scheduler), 3)
+
+    def test_attempted_message_is_not_superseded(self):
+        first = push_delivery(self.first)
+        first.attempts = 1
+        self.scheduler.retry(first)
+        self.scheduler.add(push_delivery(self.second))
+        self.assertEqual(len(self.scheduler), 2)
+
+    def test_origin_keeps_listed_commits(self):
+        push = benchmark.make_push(10)
+        message = response.message_from_push(
+            push, max_commits=3, seen_commits={push['commits'][1]['id']})
+        doc = json.loads(json.dumps(message.origin.document()))
+        self.assertEqual([c['id'] for c in doc['push']['commits']],
+                         [push['commits'][i]['id'] for i in (0, 2, 3)])
+        self.assertEqual((doc['push']['commit_count'],
+                          doc['push']['seen_count']), (10, 1))
+        self.assertEqual(doc['seen_commits'], [])
+
+        origin = response.PushOrigin.from_document(doc)
+        self.assertEqual(
+            response.message_from_push(
+                origin.push, seen_commits=origin.seen_commits,
+                **origin.options).document(),
+            message.document())
+
+    def test_origin_of_mostly_seen_push_is_bounded(self):
+        push = benchmark.make_push(5000)
+        seen = {c['id'] for c in push['commits'][:4990]}
+        message = response.message_from_push(push, seen_commits=seen)
+        self.assertEqual(len(message.origin.push['commits']), 10)
+        self.assertEqual(message.origin.seen_commits, frozenset())
+        self.assertEqual((message.origin.commit_count,
+                          message.origin.seen_count), (5000, 4990))
+
+    def test_large_push_with_commit_url_rule(self):
+        push = benchmark.make_push(60)
+        (view, username, channel), = response.apply_rules(
+            push, [{'commit_url': 'https://git.example.com/{commit}'}])
+        message = response.message_from_push(view)
+        self.assertEqual(message.attachments[0].text.split('\n')[-1],
+                         '\u2026 and 10 more')
+        self.assertEqual(len(message.origin.push['commits']), 50)
+        self.assertEqual(
+            message.origin.document()['push']['commits'][0]['url'],
+            'https://git.example.com/' + push['commits'][0]['id'])
+
+    def test_merged_large_pushes_stay_bounded(self):
+        first = benchmark.make_push(80)
+        second = benchmark.make_push(80, seed=1)
+        second['before'] = first['after']
+        self.scheduler.add(push_delivery(first))
+        self.scheduler.add(push_delivery(second))
+
+        merged = self.scheduler.next_delivery().message
+        self.assertEqual(merged.attachments[0].fallback,
+                         '[org/repo-0:master] 160 new commits')
+        self.assertEqual(len(merged.origin.push['commits']), 50)
+        self.assertEqual(merged.origin.commit_count, 160)
+        lines = merged.attachments[0].text.split('\n')
+        self.assertEqual(lines[-1], '\u2026 and 110 more')
+
+    def test_merged_compare_url_starts_at_first_push(self):
+        url = 'https://git.example.com/org/repo-0/compare/{}...{}'
+        self.first['url'] = url.format(self.first['before'][:12],
+                                       self.first['after'][:12])
+        self.second['url'] = url.format(self.second['before'][:12],
+                                        self.second['after'][:12])
+        self.scheduler.add(push_delivery(self.first))
+        self.scheduler.add(push_delivery(self.second))
+
+        merged = self.scheduler.next_delivery().message
+        self.assertEqual(merged.origin.push['url'],
+                         url.format(self.first['before'][:12],
+                                    self.second['after'][:12]))
+
+    def test_origin_document_round_trip(self):
+        message = response.message_from_push(self.first)
+        origin = response.PushOrigin.from_document(
+            json.loads(json.dumps(message.origin.document())))
+        self.assertEqual(origin.key, message.origin.key)
+        self.assertEqual(
+            response.message_from_push(origin.push).document(),
+            message.document())
+
+
+class TestRateLimiting(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = ratelimit.RateLimiter(
+            0.1, burst=1, clock=lambda: self.now)
+
+    def test_token_bucket_refills(self):
+        bucket = ratelimit.TokenBucket(0.5, burst=2, now=0.0)
+        self.assertTrue(bucket.consume(0.0))
+        self.assertTrue(bucket.consume(0.0))
+        self.assertFalse(bucket.consume(0.0))
+        self.assertAlmostEqual(bucket.wait_time(1.0), 1.0)
+        self.assertTrue(bucket.consume(2.0))
+
+    def test_blocked_bucket_waits(self):
+        bucket = ratelimit.TokenBucket(10, now=0.0)
+        bucket.block(30, 0.0)
+        self.assertAlmostEqual(bucket.wait_time(10.0), 20.0)
+        self.assertTrue(bucket.consume(30.0))
+
+    def test_busy_channel_does_not_block_other_channels(self):
+        scheduler = slack.MessageScheduler(limiter=self.limiter,
+                                           endpoint_burst=10)
+        scheduler.add(delivery('a', channel='#busy'))
+        self.assertEqual(scheduler.next_delivery().channel, '#busy')
+
+        scheduler.add(delivery('b', channel='#busy'))
+        scheduler.add(delivery('c', channel='#quiet'))
+        self.assertEqual(scheduler.next_delivery().channel, '#quiet')
+        self.assertIsNone(scheduler.next_delivery())
+        self.assertAlmostEqual(scheduler.wait_time(), 10.0)
+
+        self.now = 10.0
+        self.assertEqual(scheduler.next_delivery().channel, '#busy')
+
+    def test_busy_channels_are_skipped(self):
+        scheduler = slack.MessageScheduler(endpoint_burst=10)
+        scheduler.add(delivery('a', channel='#a'))
+        self.assertIsNone(scheduler.next_delivery(busy={(None, '#a')}))
+        self.assertIsNone(scheduler.wait_time(busy={(None, '#a')}))
+        self.assertEqual(scheduler.next_delivery().channel, '#a')
+
+    def test_retry_after_only_blocks_channel(self):
+        self.limiter.block((None, '#a'), 60)
+        self.assertAlmostEqual(self.limiter.wait_time((None, '#a')), 60.0)
+        self.assertEqual(self.limiter.wait_time((None, '#b')), 0.0)
+
+    def test_retry_after_is_parsed(self):
+        now = 784111777.0
+        self.assertEqual(slack.parse_retry_after('30'), 30.0)
+        self.assertEqual(slack.parse_retry_after('1.5'), 1.5)
+        self.assertEqual(slack.parse_retry_after('-1'), 0.0)
+        self.assertEqual(slack.parse_retry_after(
+            'Sun, 06 Nov 1994 08:49:57 GMT', now), 20.0)
+        for value in ('soon', '', 'nan', 'inf', None):
+            self.assertIsNone(slack.parse_retry_after(value, now))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(StubHandler, self).setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.requests.append(self.rfile.read(length))
+        status, headers = self.server.responses.pop(0) if \
+            self.server.responses else (200, {})
+        body = b'ok'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.close_after_response:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """Local HTTP server standing in for the Slack WebHook endpoint"""
+    daemon_threads = True
+
+    def __init__(self):
+        super(StubServer, self).__init__(('127.0.0.1', 0), StubHandler)
+        self.connections = 0
+        self.requests = []
+        self.responses = []
+        self.close_after_response = False
+        self.url = 'http://127.0.0.1:{}/hook'.format(self.server_port)
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.pool = connection.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_connection_is_reused(self):
+        for i in range(3):
+            response = self.pool.post(self.server.url, b'{}')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, b'ok')
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.requests, [b'{}'] * 3)
+
+    def test_reconnect_after_server_closes_connection(self):
+        self.pool.post(self.server.url, b'1')
+        self.server.close_after_response = True
+        self.pool.post(self.server.url, b'2')
+        self.pool.post(self.server.url, b'3')
+        self.assertEqual(self.server.requests, [b'1', b'2', b'3'])
+
+    def test_error_status_raises(self):
+        self.server.responses.append((429, {'Retry-After': '30'}))
+        with self.assertRaises(HTTPError) as cm:
+            self.pool.post(self.server.url, b'{}')
+        self.assertEqual(cm.exception.code, 429)
+        self.assertEqual(cm.exception.headers.get('Retry-After'), '30')
+
+        self.pool.post(self.server.url, b'{}')
+        self.assertEqual(self.server.connections, 1)
+
+
+class TestSlackWebHook(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_messages_are_posted(self):
+        hook = slack.SlackWebHook(self.server.url, endpoint_burst=2)
+        hook.enqueue(attachment_message('a', channel='#a'))
+        hook.enqueue(attachment_message('b', channel='#b'))
+        hook.start()
+        deadline = time.monotonic() + 5
+        while len(self.server.requests) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        hook.stop()
+        hook.join(5)
+
+        channels = [json.loads(r.decode())['channel']
+                    for r in self.server.requests]
+        self.assertEqual(channels, ['#a', '#b'])
+        self.assertEqual(self.server.connections, 1)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_callback_after_delivery(self):
+        delivered = []
+        hook = slack.SlackWebHook(self.server.url)
+        hook.enqueue(attachment_message('a'),
+                     lambda: delivered.append(len(self.server.requests)))
+        hook.start()
+        self.wait_for(lambda: delivered)
+        hook.stop()
+        hook.join(5)
+
+        self.assertEqual(delivered, [1])
+
+    def test_server_error_is_retried(self):
+        self.server.responses.append((500, {}))
+        delivered = []
+        hook = slack.SlackWebHook(self.server.url, retry_delay=0.01,
+                                  rate=100, endpoint_rate=100)
+        hook.enqueue(attachment_message('a'), lambda: delivered.append(1))
+        hook.start()
+        self.wait_for(lambda: delivered)
+        hook.stop()
+        hook.join(5)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(hook.health()['retries'], 1)
+        self.assertEqual(hook.health()['delivered'], 1)
+
+    def test_unparsable_retry_after_uses_backoff(self):
+        self.server.responses.append((429, {'Retry-After': 'soon'}))
+        delivered = []
+        hook = slack.SlackWebHook(self.server.url, retry_delay=0.01,
+                                  rate=100, endpoint_rate=100)
+        hook.enqueue(attachment_message('a'), lambda: delivered.append(1))
+        hook.start()
+        self.wait_for(lambda: delivered)
+        hook.stop()
+        hook.join(5)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(hook.health()['delivered'], 1)
+
+    def test_posts_are_recorded_in_metrics(self):
+        self.server.responses.append((500, {}))
+        errors = slack.POSTS.labels(500).value
+        posted = slack.POSTS.labels(200).value
+        retries = slack.RETRIES.value
+        observed = slack.DELIVERY_SECONDS.count
+        delivered = []
+        hook = slack.SlackWebHook(self.server.url, retry_delay=0.01,
+                                  rate=100, endpoint_rate=100)
+        hook.enqueue(attachment_message('a'), lambda: delivered.append(1))
+        hook.start()
+        self.wait_for(lambda: delivered)
+        hook.stop()
+        hook.join(5)
+
+        self.assertEqual(slack.POSTS.labels(500).value, errors + 1)
+        self.assertEqual(slack.POSTS.labels(200).value, posted + 1)
+        self.assertEqual(slack.RETRIES.value, retries + 1)
+        self.assertEqual(slack.DELIVERY_SECONDS.count, observed + 1)
+
+    def test_trace_marks_delivery(self):
+        traces = []
+        tracer = trace.Tracer(slow_threshold=0, sink=traces.append)
+        push_trace = tracer.start(repository='a')
+        hook = slack.SlackWebHook(self.server.url)
+        hook.enqueue(attachment_message('a'), trace=push_trace)
+        hook.start()
+        self.wait_for(lambda: traces)
+        hook.stop()
+        hook.join(5)
+
+        events = [e['event'] for e in traces[0]['events']]
+        self.assertEqual(events, ['received', 'enqueued', 'dequeued', 'post',
+                                  'posted', 'done'])
+        self.assertEqual(traces[0]['push'], {'repository': 'a'})
+
+    def test_client_error_is_dead_lettered(self):
+        self.server.responses.append((400, {}))
+        dead = []
+        delivered = []
+        hook = slack.SlackWebHook(
+            self.server.url, dead_letter=lambda m, e: dead.append(e.code))
+        hook.enqueue(attachment_message('a'), lambda: delivered.append(1))
+        hook.start()
+        self.wait_for(lambda: delivered)
+        hook.stop()
+        hook.join(5)
+
+        self.assertEqual(dead, [400])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(hook.health()['dead_letters'], 1)
+
+    def test_retry_budget(self):
+        self.server.responses.extend([(503, {})] * 3)
+        dead = []
+        hook = slack.SlackWebHook(
+            self.server.url, max_retries=2, retry_delay=0.01,
+            rate=100, endpoint_rate=100,
+            dead_letter=lambda m, e: dead.append(e.code))
+        hook.enqueue(attachment_message('a'))
+        hook.start()
+        self.wait_for(lambda: dead)
+        hook.stop()
+        hook.join(5)
+
+        self.assertEqual(dead, [503])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_worker_is_restarted(self):
+        hook = slack.SlackWebHook(self.server.url)
+        next_delivery = hook._scheduler.next_delivery
+
+        def fail_once(*args):
+            hook._scheduler.next_delivery = next_delivery
+            raise RuntimeError('failure')
+        hook._scheduler.next_delivery = fail_once
+        hook._restart_delay = lambda: 0.01
+
+        hook.enqueue(attachment_message('a'))
+        hook.start()
+        self.wait_for(lambda: self.server.requests)
+        health = hook.health()
+        hook.stop()
+        hook.join(5)
+
+        self.assertTrue(health['alive'])
+        self.assertEqual(health['restarts'], 1)
+        self.assertEqual(health['last_error'], 'failure')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_delivery_taken_from_queue_is_kept(self):
+        delivered = []
+        hook = slack.SlackWebHook(self.server.url)
+        add = hook._scheduler.add
+
+        def fail_once(delivery):
+            hook._scheduler.add = add
+            raise RuntimeError('failure')
+        hook._scheduler.add = fail_once
+        hook._restart_delay = lambda: 0.01
+
+        hook.enqueue(attachment_message('a'), lambda: delivered.append(1))
+        hook.start()
+        self.wait_for(lambda: delivered)
+        health = hook.health()
+        hook.stop()
+        hook.join(5)
+
+        self.assertEqual(health['restarts'], 1)
+        self.assertEqual(delivered, [1])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_enqueue_blocks_when_full(self):
+        hook = slack.SlackWebHook(self.server.url, max_queue_size=1,
+                                  endpoint_burst=2)
+        hook.enqueue(attachment_message('a', channel='#a'))
+        producer = threading.Thread(target=hook.enqueue, args=(
+            attachment_message('b', channel='#b'),))
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+
+        hook.start()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.wait_for(lambda: len(self.server.requests) == 2)
+        hook.stop()
+        hook.join(5)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestAsyncSlackWebHook(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_messages_are_posted(self):
+        hook = aio.AsyncSlackWebHook(self.server.url, endpoint_burst=3)
+        hook.start()
+        for channel in ('#a', '#b', '#a'):
+            hook.enqueue(attachment_message(channel, channel=channel))
+        deadline = time.monotonic() + 5
+        while len(self.server.requests) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        hook.stop()
+        hook.join(5)
+
+        messages = [json.loads(r.decode()) for r in self.server.requests]
+        self.assertEqual(sorted(m['channel'] for m in messages),
+                         ['#a', '#b'])
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segments(self):
+        return sorted(os.listdir(self.path))
+
+    def test_pending_documents_are_replayed(self):
+        s = spool.Spool(self.path)
+        first = s.append({'text': 'a'})
+        s.append({'text': 'b'})
+        s.mark_delivered(first)
+        s.close()
+
+        s = spool.Spool(self.path)
+        self.assertEqual([doc for _, doc in s.pending()], [{'text': 'b'}])
+        s.close()
+
+    def test_delivered_segments_are_deleted(self):
+        s = spool.Spool(self.path, segment_size=64)
+        ids = [s.append({'text': 'x' * 32}) for _ in range(4)]
+        self.assertGreater(len(self.segments()), 2)
+        for entry_id in ids:
+            s.mark_delivered(entry_id)
+        self.assertEqual(len(self.segments()), 1)
+        s.close()
+
+        s = spool.Spool(self.path)
+        self.assertEqual(s.pending(), [])
+        s.close()
+
+    def test_old_segments_are_compacted(self):
+        s = spool.Spool(self.path, segment_size=64, max_segments=3)
+        ids = [s.append({'text': str(i) * 32}) for i in range(10)]
+        self.assertLessEqual(len(self.segments()), 3)
+        s.mark_delivered(ids[1])
+        s.close()
+
+        s = spool.Spool(self.path)
+        self.assertEqual([doc['text'][0] for _, doc in s.pending()],
+                         [str(i) for i in range(10) if i != 1])
+        s.close()
+
+    def test_truncated_record_is_ignored(self):
+        s = spool.Spool(self.path)
+        s.append({'text': 'a'})
+        s.append({'text': 'b'})
+        s.close()
+
+        segment = os.path.join(self.path, self.segments()[0])
+        with open(segment, 'r+b') as f:
+            f.truncate(os.path.getsize(segment) - 1)
+
+        s = spool.Spool(self.path)
+        self.assertEqual([doc for _, doc in s.pending()], [{'text': 'a'}])
+        s.close()
+
+    def test_sync_waits_for_flusher(self):
+        s = spool.Spool(self.path, sync_interval=0.01)
+        s.append({'text': 'a'})
+        s.sync()
+        s.close()
+
+    def test_hook_replays_spool(self):
+        s = spool.Spool(self.path)
+        hook = slack.SlackWebHook(spool=s)
+        hook.enqueue(attachment_message('a', channel='#a'))
+        s.close()
+
+        s = spool.Spool(self.path)
+        hook = slack.SlackWebHook(spool=s)
+        delivery = hook._scheduler.next_delivery()
+        self.assertEqual(delivery.message.document(),
+                         attachment_message('a', channel='#a').document())
+        hook._done(delivery)
+        self.assertEqual(s.pending(), [])
+        s.close()
+
+
+def digest_entry(repository, branch, commits, authors, channel='#git',
+                 window=300):
+    return digest.DigestEntry(repository, branch, commits, authors, None,
+                              channel, window)
+
+
+class TestDigest(unittest.TestCase):
+    def test_digest_is_posted_when_window_ends(self):
+        clock = FakeClock()
+        collector = digest.DigestCollector(clock=clock)
+        collector.add(digest_entry('org/a', 'master', 3, {'Ann': 3}))
+        clock.now += 100
+        collector.add(digest_entry('org/b', 'dev', 1, {'Bob': 1}))
+        collector.add(digest_entry('org/a', 'master', 2,
+                                   {'Ann': 1, 'Bob': 1}))
+        collector.add(digest_entry('org/a', 'master', 1, {'Cy': 1},
+                                   channel='#other'))
+        self.assertEqual(collector.due(), [])
+
+        clock.now += 200
+        (message, spool_ids), = collector.due()
+        self.assertEqual(spool_ids, [])
+        self.assertEqual(len(collector), 1)
+        attachment = message.attachments[0]
+        self.assertEqual(message.channel, '#git')
+        self.assertEqual(attachment.pretext,
+                         'Digest of the last 5 minutes: 6 commits in'
+                         ' 3 pushes')
+        self.assertEqual(attachment.text.split('\n'), [
+            '[org/a:master] 5 commits in 2 pushes',
+            '[org/b:dev] one commit in one push',
+            'Top authors: Ann (4), Bob (2)'])
+
+        self.assertEqual(len(collector.due(flush=True)), 1)
+
+    def test_spooled_entries_survive_restart(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        clock = FakeClock()
+        collector = digest.DigestCollector(clock=clock,
+                                           spool=spool.Spool(path))
+        collector.add(digest_entry('org/a', 'master', 3, {'Ann': 3}))
+        collector.add(digest_entry('org/b', 'dev', 1, {'Bob': 1}))
+        collector.close()
+
+        collector = digest.DigestCollector(clock=clock,
+                                           spool=spool.Spool(path))
+        self.assertEqual(collector.due(), [])
+        clock.now += 300
+        (message, _), = collector.due()
+        self.assertEqual(message.attachments[0].pretext,
+                         'Digest of the last 5 minutes: 4 commits in'
+                         ' 2 pushes')
+        collector.close()
+
+        # Kept until the message has been enqueued
+        collector = digest.DigestCollector(clock=clock,
+                                           spool=spool.Spool(path))
+        (_, spool_ids), = collector.due(flush=True)
+        self.assertEqual(len(spool_ids), 2)
+        collector.enqueued(spool_ids)
+        collector.close()
+
+        collector = digest.DigestCollector(clock=clock,
+                                           spool=spool.Spool(path))
+        self.assertEqual(len(collector), 0)
+        collector.close()
+
+    def test_branch_list_is_limited(self):
+        d = digest.Digest('#git', None, 3600, 0, max_branches=2)
+        for i in range(5):
+            d.add(digest_entry('org/{}'.format(i), 'master', 1, {}))
+        lines = d.message().attachments[0].text.split('\n')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1], '\u2026 3 branches not shown')
+        self.assertEqual(d.message().attachments[0].pretext,
+                         'Digest of the last hour: 5 commits in 5 pushes')
+
+    def test_top_counts_are_bounded(self):
+        counts = digest.TopCounts(2)
+        for name in ['a'] * 5 + ['b', 'c', 'd']:
+            counts.add(name)
+        self.assertEqual(counts.most_common(1), [('a', 5)])
+        self.assertEqual(len(counts.most_common(10)), 2)
+
+    def test_format_window(self):
+        self.assertEqual(digest.format_window(60), 'minute')
+        self.assertEqual(digest.format_window(7200), '2 hours')
+        self.assertEqual(digest.format_window(90), '90 seconds')
+
+
+class TestMarkupTemplate(unittest.TestCase):
+    def assertSameAsMarkup(self, template, *args, **kwargs):
+        result = slack.MarkupTemplate(template).format(*args, **kwargs)
+        formatter = slack._MarkupEscapeFormatter(slack.Markup.escape)
+        mapping = slack._MagicFormatMapping(args, kwargs)
+        expected = formatter.vformat(template, args, mapping)
+        self.assertIsInstance(result, slack.Markup)
+        self.assertEqual(result, expected)
+
+    def test_positional_fields(self):
+        self.assertSameAsMarkup('{}: {} - {}', 'a<b',
+                                slack.Link('http://x/?a&b', 't<'), 'P&Q')
+
+    def test_numbered_and_named_fields(self):
+        self.assertSameAsMarkup('{0}{1}{0}', '<', '>')
+        self.assertSameAsMarkup('{a} {b}', a=1, b=slack.Markup('<i>'))
+
+    def test_escaped_braces(self):
+        self.assertSameAsMarkup('{{}} {}', 3.5)
+
+    def test_complex_fields(self):
+        self.assertSameAsMarkup('{:>5} {!r}', '<', '&')
+        self.assertSameAsMarkup('{0.real}', 3)
+
+    def test_markup_format_uses_template(self):
+        self.assertEqual(slack.Markup('<{}>').format('a&b'), '<a&amp;b>')
+
+    def test_escape(self):
+        self.assertEqual(slack.Markup.escape('<a & b>'),
+                         '&lt;a &amp; b&gt;')
+        self.assertEqual(slack.Markup.escape(slack.Markup('<b>')), '<b>')
+
+
+class TestMessageDocument(unittest.TestCase):
+    def test_message_from_document(self):
+        message = slack.Message(
+            text='a < b', username='bot', channel='#a', attachments=[
+                slack.Attachment('fallback <', color='good',
+                                 pretext=slack.Link('http://x/?a&b', 'x'),
+                                 author=slack.Author('me', 'http://me'),
+                                 title='T&T', text='1 > 0')])
+        doc = message.document()
+        self.assertEqual(slack.Message.from_document(doc).document(), doc)
+
+    def test_message_is_immutable(self):
+        message = slack.Message(text='a', attachments=[
+            slack.Attachment('b', author=slack.Author('me'))])
+        with self.assertRaises(AttributeError):
+            message.text = 'b'
+        with self.assertRaises(AttributeError):
+            message.attachments[0].text = 'c'
+        with self.assertRaises(AttributeError):
+            message.attachments[0].author.name = 'you'
+        with self.assertRaises(AttributeError):
+            message.extra = 1
+
+    def test_payload_is_cached(self):
+        message = slack.Message(text='a < b', channel='#a')
+        self.assertIs(message.document(), message.document())
+        self.assertIs(message.payload(), message.payload())
+        self.assertEqual(json.loads(message.payload().decode()),
+                         {'text': 'a &lt; b', 'channel': '#a'})
+
+    def test_merge_attachments(self):
+        a = slack.Message(attachments=[slack.Attachment('a')])
+        b = slack.Message(text='b', attachments=[slack.Attachment('b')])
+        merged = a.merge(b)
+        self.assertEqual([x['fallback'] for x in
+                          merged.document()['attachments']], ['a', 'b'])
+        self.assertEqual(merged.document()['text'], 'b')
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_push_renders(self):
+        push = benchmark.make_push(3, repository='org/repo-7')
+        message = response.message_from_push(push).document()
+        self.assertEqual(len(message['attachments'][0]['text'].split('\n')),
+                         3)
+
+    def test_synthetic_rules_route_repository(self):
+        rules = benchmark.make_rules(20)
+        push = benchmark.make_push(1, repository='org/repo-7')
+        result = list(response.apply_rules(push, rules))
+        self.assertEqual(result[0][2], '#repo-7')
+
+    def test_compare_reports_regressions(self):
+        baseline = {'results': {'a': {'seconds': 1.0},
+                                'b': {'seconds': 1.0}}}
+        current = {'results': {'a': {'seconds': 1.2}, 'b': {'seconds': 1.5},
+                               'c': {'seconds': 9.0}}}
+        self.assertEqual(benchmark.compare(current, baseline, 0.25),
+                         [('b', 1.0, 1.5)])
+
+    def test_run_filter(self):
+        result = benchmark.run('^markup/escape/short$', min_time=0.001,
+                               repeat=1)
+        self.assertEqual(list(result['results']), ['markup/escape/short'])
+        self.assertGreater(result['results']['markup/escape/short'][
+            'seconds'], 0)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = metrics.Counter('pushes', 'Pushes', registry=self.registry)
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(counter.value, 3)
+        self.assertEqual(self.registry.exposition(),
+                         '# HELP pushes_total Pushes\n'
+                         '# TYPE pushes_total counter\n'
+                         'pushes_total 3.0\n')
+
+    def test_type_lines_match_sample_names(self):
+        metrics.Counter('pushes', 'Pushes', ['status'],
+                        registry=self.registry).labels(200).inc()
+        metrics.Gauge('depth', 'Depth', registry=self.registry)
+        metrics.Histogram('latency', 'Latency', buckets=(1,),
+                          registry=self.registry).observe(1)
+        suffixes = {'counter': ('',), 'gauge': ('',),
+                    'histogram': ('_bucket', '_sum', '_count')}
+        families = []
+        for line in self.registry.exposition().splitlines():
+            if line.startswith('# TYPE '):
+                family, family_type = line.split()[2:]
+                families.append(family)
+            elif not line.startswith('#'):
+                sample = line.split(' ')[0].split('{')[0]
+                self.assertIn(sample, [family + suffix for suffix
+                                       in suffixes[family_type]])
+        self.assertEqual(families, ['depth', 'latency', 'pushes_total'])
+
+    def test_labels(self):
+        counter = metrics.Counter('posts', 'Posts', ['status'],
+                                  registry=self.registry)
+        counter.labels(200).inc()
+        counter.labels('a"b').inc()
+        lines = self.registry.exposition().splitlines()
+        self.assertIn('posts_total{status="200"} 1.0', lines)
+        self.assertIn('posts_total{status="a\\"b"} 1.0', lines)
+        with self.assertRaises(ValueError):
+            counter.labels(1, 2)
+
+    def test_duplicate_name(self):
+        metrics.Gauge('depth', 'Depth', registry=self.registry)
+        with self.assertRaises(ValueError):
+            metrics.Gauge('depth', 'Depth', registry=self.registry)
+
+    def test_gauge_function(self):
+        gauge = metrics.Gauge('depth', 'Depth', registry=self.registry)
+        gauge.set(4)
+        self.assertEqual(gauge.value, 4)
+        gauge.set_function(lambda: 7)
+        self.assertIn('depth 7', self.registry.exposition().splitlines())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('latency', 'Latency', buckets=(1, 2),
+                                      registry=self.registry)
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+        lines = self.registry.exposition().splitlines()
+        self.assertEqual(lines[2:], [
+            'latency_bucket{le="1.0"} 2',
+            'latency_bucket{le="2.0"} 3',
+            'latency_bucket{le="+Inf"} 4',
+            'latency_sum 6.0',
+            'latency_count 4'])
+
+    def test_server(self):
+        metrics.Counter('pushes', 'Pushes', registry=self.registry).inc()
+        server = metrics.MetricsServer(0, registry=self.registry)
+        server.start()
+        try:
+            pool = connection.ConnectionPool()
+            resp = pool.request(
+                'GET', 'http://127.0.0.1:{}/metrics'.format(server.port))
+            pool.close()
+        finally:
+            server.stop()
+        self.assertIn(b'pushes_total 1.0', resp.body)
+
+
+class TestTrace(unittest.TestCase):
+    def test_unsampled(self):
+        self.assertIsNone(trace.Tracer(sample_rate=0).start())
+
+    def test_only_slow_traces_reported(self):
+        traces = []
+        tracer = trace.Tracer(slow_threshold=60, sink=traces.append)
+        tracer.start().finish()
+        self.assertEqual(traces, [])
+
+        tracer = trace.Tracer(slow_threshold=0, sink=traces.append)
+        push_trace = tracer.start(ref='refs/heads/master')
+        push_trace.mark('rules')
+        push_trace.mark('retry', 1.5)
+        push_trace.finish()
+        push_trace.finish()
+        self.assertEqual(len(traces), 1)
+        self.assertEqual([e['event'] for e in traces[0]['events']],
+                         ['received', 'rules', 'retry', 'done'])
+        self.assertEqual(traces[0]['events'][2]['detail'], 1.5)
+        self.assertEqual(traces[0]['duration'],
+                         traces[0]['events'][-1]['offset'])
+
+    def test_trace_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'traces.jsonl')
+        tracer = trace.Tracer(slow_threshold=0, sink=trace.TraceFile(path))
+        tracer.start(repository='a').finish()
+        with open(path) as f:
+            document = json.loads(f.readline())
+        self.assertEqual(document['push'], {'repository': 'a'})
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, formatter=None):
+        super(RecordingHandler, self).__init__()
+        self.records = []
+        self.lines = []
+        if formatter is not None:
+            self.setFormatter(formatter)
+
+    def emit(self, record):
+        self.records.append(record)
+        self.lines.append(self.format(record))
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('git_slack.tests.events')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = RecordingHandler()
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        self.addCleanup(log.configure_events, None)
+        self.log = log.EventLog(self.logger)
+
+    def test_disabled_level_is_not_formatted(self):
+        calls = []
+        self.log.debug('document', 'Message {doc}',
+                       doc=lambda: calls.append(1))
+        self.assertEqual(calls, [])
+        self.assertEqual(self.handler.records, [])
+
+    def test_fields_are_formatted_lazily(self):
+        self.log.info('push', 'Push to {repository}: {size} bytes',
+                      repository='a', size=lambda: 10)
+        self.assertEqual(self.handler.lines, ['Push to a: 10 bytes'])
+
+    def test_sampling(self):
+        log.configure_events({'push': {'sample': 0}})
+        for _ in range(10):
+            self.log.info('push', 'Push')
+        self.log.info('other', 'Other')
+        self.assertEqual(self.handler.lines, ['Other'])
+
+    def test_rate_cap_counts_suppressed(self):
+        log.configure_events({'push': {'max_rate': 0.001, 'burst': 1}})
+        for _ in range(5):
+            self.log.info('push', 'Push')
+        self.assertEqual(self.handler.lines, ['Push'])
+
+        # Refill bucket
+        log._settings['push'].bucket._tokens = 1.0
+        self.log.info('push', 'Push')
+        self.assertEqual(self.handler.records[-1].event.fields,
+                         {'suppressed': 4})
+
+    def test_structured_formatter(self):
+        self.handler.setFormatter(log.StructuredFormatter())
+        self.log.warning('give_up', 'Giving up after {attempts} attempts',
+                         attempts=3)
+        doc = json.loads(self.handler.lines[0])
+        self.assertEqual(doc['event'], 'give_up')
+        self.assertEqual(doc['attempts'], 3)
+        self.assertEqual(doc['message'], 'Giving up after 3 attempts')
+        self.assertEqual(doc['level'], 'WARNING')
+
+    def test_post_does_not_serialize_document_at_info(self):
+        logger = logging.getLogger('git_slack.slack')
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.setLevel, level)
+
+        hook = slack.BaseWebHook()
+        hook._log_post(slack.Delivery(attachment_message('a',
+                                                         channel='#a')))
+        self.assertEqual([r.event.name for r in handler.records], ['post'])
+        self.assertIn('#a', handler.records[0].getMessage())
+
+
+class AckMessage(object):
+    """Stand-in for AMQP message"""
+    def __init__(self):
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+class RecordingHook(object):
+    def __init__(self):
+        self.enqueued = []
+
+    def enqueue(self, message, callback=None, trace=None):
+        self.enqueued.append((message, callback, trace))
+
+
+@unittest.skipIf(daemon is None, 'kombu is not installed')
+class TestDaemon(unittest.TestCase):
+    def test_push_acknowledged_when_delivered(self):
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, {'slack': {'channel': '#git'}})
+        message = AckMessage()
+        handler(benchmark.make_push(1), message)
+        self.assertFalse(message.acked)
+        self.assertEqual(hook.enqueued[0][0].channel, '#git')
+
+        hook.enqueued[0][1]()
+        self.assertFalse(message.acked)
+        handler.ack_delivered()
+        self.assertTrue(message.acked)
+
+    def test_push_is_traced(self):
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, {'tracing': {}})
+        handler(benchmark.make_push(1), AckMessage())
+        push_trace = hook.enqueued[0][2]
+        self.assertEqual(push_trace.attributes['repository'], 'org/repo-0')
+        self.assertEqual([e[0] for e in push_trace.events],
+                         ['received', 'rules', 'rendered'])
+
+    def test_filtered_push_acknowledged(self):
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, {'rules': [
+            {'repository': 'org/.*', 'filter': 'exclude'}]})
+        message = AckMessage()
+        handler(benchmark.make_push(1), message)
+        self.assertTrue(message.acked)
+        self.assertEqual(hook.enqueued, [])
+
+    def test_announced_commits_are_counted(self):
+        renderer = daemon.PushRenderer({'seen_commits': {}})
+        feature = benchmark.make_push(2, branch='feature')
+        text = renderer.render(feature)[0].attachments[0].text
+        self.assertEqual(len(text.split('\n')), 2)
+
+        master = benchmark.make_push(1, seed=1)
+        master['commits'] += feature['commits']
+        text = renderer.render(master)[0].attachments[0].text
+        self.assertEqual(text.split('\n')[-1],
+                         '2 commits already announced')
+
+    def test_digest_push_is_acknowledged(self):
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, {'rules': [
+            {'repository': 'org/.*', 'channel': '#ci', 'digest': 60}]})
+        message = AckMessage()
+        handler(benchmark.make_push(2), message)
+        handler(benchmark.make_push(1, seed=1), AckMessage())
+        self.assertTrue(message.acked)
+        self.assertEqual(hook.enqueued, [])
+
+        handler.flush_digests()
+        self.assertEqual(hook.enqueued, [])
+        handler.close()
+        digest_message = hook.enqueued[0][0]
+        self.assertEqual(digest_message.channel, '#ci')
+        self.assertEqual(digest_message.attachments[0].text.split('\n')[0],
+                         '[org/repo-0:master] 3 commits in 2 pushes')
+
+    def test_reload_replaces_rules(self):
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, {'rules': [{'channel': '#a'}]})
+        handler(benchmark.make_push(1), AckMessage())
+        handler.reload({'rules': [{'channel': '#b'}]})
+        handler(benchmark.make_push(1, seed=1), AckMessage())
+        self.assertEqual([m.channel for m, _, _ in hook.enqueued],
+                         ['#a', '#b'])
+
+        with self.assertRaises(response.RulesError):
+            handler.reload({'rules': [{'filter': 'maybe'}]})
+        handler(benchmark.make_push(1, seed=2), AckMessage())
+        self.assertEqual(hook.enqueued[-1][0].channel, '#b')
+
+    def test_reload_keeps_seen_commits(self):
+        renderer = daemon.PushRenderer({'seen_commits': {}})
+        push = benchmark.make_push(1)
+        renderer.render(push)
+        renderer = daemon.PushRenderer(
+            {'seen_commits': {}, 'slack': {'channel': '#git'}}, renderer)
+        text = renderer.render(push)[0].attachments[0].text
+        self.assertEqual(text, 'one commit already announced')
+
+    def test_restart_changes(self):
+        self.assertEqual(daemon.restart_changes(
+            {'slack': {'channel': '#a', 'rate': 1}, 'workers': 2},
+            {'slack': {'channel': '#b', 'rate': 2}, 'rules': []}),
+            ['workers', 'slack.rate'])
+
+    def test_config_file_is_reloaded(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        path = os.path.join(path, 'config.yaml')
+        with open(path, 'w') as f:
+            f.write('rules:\n  - channel: "#a"\n')
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, daemon.load_config(path))
+        reloader = daemon.ConfigReloader(path, handler, 0.01)
+        reloader.start()
+        self.addCleanup(reloader.join)
+        self.addCleanup(reloader.stop)
+
+        with open(path, 'w') as f:
+            f.write('rules:\n  - channel: "#changed"\n')
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            handler(benchmark.make_push(1, seed=len(hook.enqueued)),
+                    AckMessage())
+            if hook.enqueued[-1][0].channel == '#changed':
+                break
+            time.sleep(0.01)
+        self.assertEqual(hook.enqueued[-1][0].channel, '#changed')
+
+        with open(path, 'w') as f:
+            f.write('rules: [\n')
+        self.assertFalse(reloader.reload())
+
+    def test_sharded_handler_reloads_workers(self):
+        hook = RecordingHook()
+        handler = daemon.ShardedPushHandler(
+            hook, {'rules': [{'channel': '#a'}]}, 2)
+        self.addCleanup(handler.close)
+        with self.assertRaises(ValueError):
+            handler.reload({'seen_commits': {'error_rate': 0}})
+        handler.reload({'rules': [{'channel': '#b'}]})
+        for i in range(4):
+            handler(benchmark.make_push(
+                1, repository='org/repo-{}'.format(i), seed=i), AckMessage())
+
+        deadline = time.monotonic() + 30
+        while len(hook.enqueued) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([m.channel for m, _, _ in hook.enqueued],
+                         ['#b'] * 4)
+
+    def test_worker_keeps_renderer_on_failed_reload(self):
+        # The worker ignores interrupts
+        self.addCleanup(signal.signal, signal.SIGINT,
+                        signal.getsignal(signal.SIGINT))
+        tasks, results = queue.Queue(), queue.Queue()
+        for task in ((None, {'seen_commits': {'error_rate': 0}}),
+                     (1, benchmark.make_push(1)), None):
+            tasks.put(task)
+        daemon._render_worker({'rules': [{'channel': '#a'}]}, tasks,
+                              results)
+        number, documents, error = results.get_nowait()
+        self.assertEqual((number, error), (1, None))
+        self.assertEqual(documents[0]['message']['channel'], '#a')
+
+    def test_pushes_of_dead_worker_are_dispatched_again(self):
+        hook = RecordingHook()
+        handler = daemon.ShardedPushHandler(hook, {}, 1)
+        self.addCleanup(handler.close)
+        handler._processes[0].kill()
+        handler._processes[0].join()
+        handler(benchmark.make_push(1), AckMessage())
+
+        deadline = time.monotonic() + 30
+        while not hook.enqueued and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(hook.enqueued), 1)
+        self.assertEqual(handler._pending, {})
+
+    def test_close_stops_workers(self):
+        handler = daemon.ShardedPushHandler(RecordingHook(), {}, 2)
+        processes = list(handler._processes)
+        handler.close()
+        self.assertFalse(any(p.is_alive() for p in handler._processes))
+        self.assertEqual(handler._processes, processes)
+
+    def test_duplicate_push_is_dropped(self):
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, {})
+        handler(benchmark.make_push(1), AckMessage())
+        duplicate = AckMessage()
+        handler(benchmark.make_push(1), duplicate)
+        self.assertTrue(duplicate.acked)
+        self.assertEqual(len(hook.enqueued), 1)
+
+        handler(benchmark.make_push(1, seed=1), AckMessage())
+        self.assertEqual(len(hook.enqueued), 2)
+
+    def test_dedupe_disabled(self):
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, {'dedupe': False})
+        handler(benchmark.make_push(1), AckMessage())
+        handler(benchmark.make_push(1), AckMessage())
+        self.assertEqual(len(hook.enqueued), 2)
+
+    def test_only_delivered_pushes_are_persisted(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        config = {'dedupe': {'file': os.path.join(path, 'dedupe.json')}}
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, config)
+        handler(benchmark.make_push(1), AckMessage())
+        handler(benchmark.make_push(1, seed=1), AckMessage())
+        hook.enqueued[0][1]()
+        handler.close()
+
+        hook = RecordingHook()
+        handler = daemon.PushHandler(hook, config)
+        handler(benchmark.make_push(1), AckMessage())
+        handler(benchmark.make_push(1, seed=1), AckMessage())
+        self.assertEqual(len(hook.enqueued), 1)
+
+    def test_shard_by_repository(self):
+        push = benchmark.make_push(1, repository='org/a')
+        other = benchmark.make_push(2, repository='org/a', seed=1)
+        self.assertEqual(daemon.shard(push, 4), daemon.shard(other, 4))
+        self.assertIn(daemon.shard({}, 4), range(4))
+
+    def test_sharded_handler_keeps_repository_order(self):
+        hook = RecordingHook()
+        handler = daemon.ShardedPushHandler(hook, {}, 2)
+        self.addCleanup(handler.close)
+        messages = []
+        for i in range(12):
+            push = benchmark.make_push(
+                1, repository='org/repo-{}'.format(i % 3), seed=i)
+            push['commits'][0]['message'] = 'push {}'.format(i)
+            messages.append(AckMessage())
+            handler(push, messages[-1])
+        tag = AckMessage()
+        handler({'ref': 'refs/tags/v1'}, tag)
+
+        deadline = time.monotonic() + 30
+        while len(hook.enqueued) < 12 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(hook.enqueued), 12)
+
+        order = {}
+        for message, callback, _ in hook.enqueued:
+            document = message.document()
+            repository = document['attachments'][0]['fallback'].split(':')[0]
+            push = int(document['attachments'][0]['text'].split(
+                'push ')[1].split(' ')[0])
+            order.setdefault(repository, []).append(push)
+            callback()
+        for pushes in order.values():
+            self.assertEqual(pushes, sorted(pushes))
+        deadline = time.monotonic() + 5
+        while len(handler._delivered) < 13 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        handler.ack_delivered()
+        self.assertTrue(all(m.acked for m in messages))
+        self.assertTrue(tag.acked)
+
+    def test_invalid_engine(self):
+        with self.assertRaises(daemon.ConfigError):
+            daemon.create_hook({'slack': {'webhook_url': 'http://x/',
+                                          'engine': 'fork'}})
+
+    def test_amqp_url_from_config(self):
+        self.assertEqual(daemon.amqp_url({'amqp': {'url': 'memory://'}}),
+                         'memory://')
+
+    def test_soak(self):
+        config = {'slack': {'rate': 100, 'burst': 10, 'endpoint_rate': 100,
+                            'retry_delay': 0.01}}
+        report = soak.Soak(rate=40, duration=0.5, repositories=4,
+                           channels=2, config=config, sample_interval=0.1,
+                           drain_timeout=10, errors=0.2, seed=1).run(
+                               warmup=0.2)
+        self.assertEqual(report['published'], 20)
+        self.assertEqual(report['delivered'], 20)
+        self.assertEqual(report['lost'], 0)
+        self.assertEqual(report['slack']['errors'] +
+                         report['slack']['accepted'],
+                         report['slack']['requests'])
+        self.assertLessEqual(report['latency']['p50'],
+                             report['latency']['max'])
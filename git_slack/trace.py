@@ -0,0 +1,104 @@
+
+"""Per-push latency tracing"""
+
+import json
+import time
+import random
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class Trace(object):
+    """Timeline of a push on its way through the daemon
+
+    Events are marked with the time elapsed since the push was received.
+    When the push has been posted or given up on, finish() passes the
+    trace to its Tracer.
+    """
+    __slots__ = ('trace_id', 'attributes', 'started', 'wall_time',
+                 'events', '_tracer', '_finished')
+
+    def __init__(self, tracer, attributes):
+        self.trace_id = '{:016x}'.format(random.getrandbits(64))
+        self.attributes = attributes
+        self.started = time.monotonic()
+        self.wall_time = time.time()
+        self.events = []
+        self._tracer = tracer
+        self._finished = False
+
+    def mark(self, event, detail=None):
+        """Record that event happened now"""
+        self.events.append((event, time.monotonic() - self.started, detail))
+
+    @property
+    def duration(self):
+        return self.events[-1][1] if self.events else 0.0
+
+    def finish(self, event='done'):
+        if self._finished:
+            return
+        self._finished = True
+        self.mark(event)
+        self._tracer.finished(self)
+
+    def document(self):
+        """Return trace as JSON document"""
+        events = []
+        for event, offset, detail in self.events:
+            entry = {'event': event, 'offset': round(offset, 6)}
+            if detail is not None:
+                entry['detail'] = detail
+            events.append(entry)
+        return {'trace_id': self.trace_id, 'time': self.wall_time,
+                'duration': round(self.duration, 6),
+                'push': self.attributes, 'events': events}
+
+
+class TraceFile(object):
+    """Trace sink appending traces as JSON lines to a file"""
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+
+    def __call__(self, document):
+        line = json.dumps(document)
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(line + '\n')
+
+
+def _log_trace(document):
+    logger.warning('Slow push: {}'.format(json.dumps(document)))
+
+
+class Tracer(object):
+    """Starts traces of a sample of pushes and reports the slow ones
+
+    A fraction sample_rate of pushes is traced. Traces of pushes that
+    took at least slow_threshold seconds from being received until they
+    were posted or given up on are passed to sink, a callable taking the
+    trace document, e.g. a TraceFile. By default they are logged.
+    """
+    def __init__(self, sample_rate=1.0, slow_threshold=60.0, sink=None):
+        self._sample_rate = sample_rate
+        self._slow_threshold = slow_threshold
+        self._sink = _log_trace if sink is None else sink
+
+    def start(self, **attributes):
+        """Return new trace or None if the push is not sampled"""
+        if self._sample_rate < 1.0 and random.random() >= self._sample_rate:
+            return None
+        trace = Trace(self, attributes)
+        trace.mark('received')
+        return trace
+
+    def finished(self, trace):
+        if trace.duration < self._slow_threshold:
+            return
+        try:
+            self._sink(trace.document())
+        except Exception:
+            logger.warning('Unable to write trace:', exc_info=True)